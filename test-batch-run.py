@@ -0,0 +1,14 @@
+import argparse
+
+from utils.batch_run import run_batch
+
+if __name__ == '__main__':
+    # manifest.json: [{"source": "mouth.mp4", "target": "inference.mp4", "output": "output.mp4",
+    #                  "audio": "inference.mp4"}, ...], or {"defaults": {"chunk_frames": 500}, "jobs": [...]}
+    # rerun the same command after a crash, finished jobs are skipped and the others resume from their last chunk
+    parser = argparse.ArgumentParser()
+    parser.add_argument("manifest", nargs="?", default="manifest.json")
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--summary", default=None)
+    args = parser.parse_args()
+    run_batch(args.manifest, args.concurrency, args.summary)
@@ -0,0 +1,16 @@
+import argparse
+
+from utils.benchmark import run_benchmarks, STAGES
+
+if __name__ == '__main__':
+    # stage-level benchmark on synthetic clips, runs offline
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--resolutions", default="640x360,1280x720,1920x1080")
+    parser.add_argument("--lengths", default="50")
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--work-dir", default="benchmark_clips")
+    args = parser.parse_args()
+    resolutions = [tuple(int(v) for v in r.split("x")) for r in args.resolutions.split(",")]
+    lengths = [int(n) for n in args.lengths.split(",")]
+    run_benchmarks(args.output, resolutions, lengths, args.stages.split(","), args.work_dir)
@@ -0,0 +1,26 @@
+from utils.face_swap_utils import SourceFace, face_swap_image_frames
+from utils.landmark_io import load_landmark_track
+from utils.frame_source import VideoFrameSource
+from utils.video_util import FFmpegWriter
+from utils.metrics import export_job_metrics
+
+if __name__ == '__main__':
+    # source face: points, crop and colour statistics are prepared once for the whole video
+    source = SourceFace.from_image_name("mouth.jpg")
+    # inference
+    inference_video_path = "inference.mp4"
+    inference_video_frames = VideoFrameSource(inference_video_path)
+    inference_video_landmarks = load_landmark_track("inference.mp4.lmk")
+    # output
+    output_video = "output.mp4"
+    w = FFmpegWriter(
+        output_video,
+        inference_video_frames.width,
+        inference_video_frames.height,
+        fps=inference_video_frames.fps or 25,
+        audio=inference_video_path
+    )
+    for result in face_swap_image_frames(source, inference_video_frames, inference_video_landmarks):
+        w.write(result)
+    w.close()
+    export_job_metrics(output_video)
@@ -0,0 +1,16 @@
+import json
+
+from utils.pipeline import FaceSwapPipeline
+
+if __name__ == '__main__':
+    # decode -> landmarks -> swap -> encode in one pass, no intermediate landmark files
+    pipeline = FaceSwapPipeline(
+        source_video="mouth.mp4",
+        target_video="inference.mp4",
+        output_video="output.mp4",
+        audio="inference.mp4",
+        # source_landmarks_path="mouth.mp4.lmk",
+        # target_landmarks_path="inference.mp4.lmk",
+    )
+    stats = pipeline.run()
+    print(json.dumps(stats, indent=2))
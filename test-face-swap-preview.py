@@ -0,0 +1,19 @@
+from utils.parallel_swap import swap_video
+from utils.preview import render_preview
+
+if __name__ == '__main__':
+    # quick look: quarter resolution, every 2nd frame
+    report = render_preview(
+        source_video="mouth.mp4",
+        target_video="inference.mp4",
+        output_video="preview.mp4",
+        scale=0.25,
+        frame_step=2,
+        anti_smooth_factor=2,
+        blend_mode="normal",
+    )
+    print(report)
+    # once the parameters look right, render at full resolution with the saved landmarks, no detection
+    frames = swap_video("mouth.mp4", "inference.mp4", report["source_landmarks"], report["target_landmarks"],
+                        "output.mp4", blend_mode="normal", audio="inference.mp4")
+    print(f"rendered {frames} frames")
@@ -0,0 +1,15 @@
+from utils.segment_swap import swap_video_segments
+
+if __name__ == '__main__':
+    # 20 s segments on a process pool, concatenated without re-encoding.
+    # To fan out over nodes, write the jobs with utils.segment_swap.write_segment_jobs into a shared
+    # directory, run `python -m utils.segment_swap <dir>/segment_*.json` on each node, then concat_segments.
+    frames = swap_video_segments(
+        source_video="mouth.mp4",
+        target_video="inference.mp4",
+        output_video="output.mp4",
+        segment_seconds=20,
+        overlap_frames=10,
+        audio="inference.mp4",
+    )
+    print(f"swapped {frames} frames")
@@ -1,34 +1,36 @@
-from utils.face_swap_utils import read_video_to_frames, read_json_data, face_swap
-import imageio.v2 as iio
+from utils.face_swap_utils import face_swap_frames
+from utils.landmark_io import load_landmark_track
+from utils.frame_source import VideoFrameSource
+from utils.video_util import FFmpegWriter
+from utils.metrics import export_job_metrics
 
 if __name__ == '__main__':
     # inference
     inference_video_path = "inference.mp4"
-    inference_video_landmarks_path = "inference.mp4.txt"
-    inference_video_frames = read_video_to_frames(inference_video_path)
-    inference_video_landmarks = read_json_data(inference_video_landmarks_path)
+    inference_video_landmarks_path = "inference.mp4.lmk"
+    inference_video_frames = VideoFrameSource(inference_video_path)
+    inference_video_landmarks = load_landmark_track(inference_video_landmarks_path)
     # mouth
     mouth_video_path = "mouth.mp4"
-    mouth_video_landmarks_path = "mouth.mp4.txt"
-    mouth_video_frames = read_video_to_frames(mouth_video_path)
-    mouth_video_landmarks = read_json_data(mouth_video_landmarks_path)
+    mouth_video_landmarks_path = "mouth.mp4.lmk"
+    mouth_video_frames = VideoFrameSource(mouth_video_path)
+    mouth_video_landmarks = load_landmark_track(mouth_video_landmarks_path)
     # output
     output_video = "output.mp4"
-    w = iio.get_writer(
+    w = FFmpegWriter(
         output_video,
-        format='FFMPEG',
-        fps=25,
-        codec='libx264',
-        quality=7,
-        macro_block_size=None,
-        ffmpeg_params=['-preset', 'medium', '-crf', '23']
+        inference_video_frames.width,
+        inference_video_frames.height,
+        fps=inference_video_frames.fps or 25,
+        preset='medium',
+        crf=23,
+        # keep the original soundtrack, muxed while encoding
+        audio=inference_video_path
     )
-    min_frames = min(len(inference_video_frames), len(mouth_video_frames))
-    for i in range(min_frames):
-        inference_video_frame = inference_video_frames[i]
-        mouth_video_frame = mouth_video_frames[i]
-        inference_video_landmark = inference_video_landmarks[i]
-        mouth_video_landmark = mouth_video_landmarks[i]
-        result = face_swap(mouth_video_frame, inference_video_frame, mouth_video_landmark, inference_video_landmark)
-        w.append_data(result)
+    # frames are decoded, swapped and written one at a time, so memory does not grow with video length
+    for result in face_swap_frames(mouth_video_frames, inference_video_frames,
+                                   mouth_video_landmarks, inference_video_landmarks):
+        w.write(result)
     w.close()
+    # FACESWAP_METRICS=1 writes output.mp4.metrics.json and output.mp4.prom
+    export_job_metrics(output_video)
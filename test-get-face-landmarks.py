@@ -1,30 +1,32 @@
 from utils.face_landmarker import *
+from utils.landmark_cache import LandmarkCache
+from utils.landmark_io import save_landmark_track
 
 
 def save_image_landmarks(img_path, save_path):
-    landmarker = MediapipeLandmarker()
-    img_lm478 = landmarker.extract_lm478_from_img_name(img_path)
+    with MediapipeLandmarker() as landmarker:
+        img_lm478 = landmarker.extract_lm478_from_img_name(img_path)
     img_lm68 = img_lm478[index_lm68_from_lm478]
     with open(save_path, "w") as f:
         for pts in img_lm68.astype(int):
             f.write(f"{pts[0]} {pts[1]}\n")
 
 
-def save_video_landmarks(video_path, save_path):
-    landmarker = MediapipeLandmarker()
-    ret = landmarker.extract_lm478_from_video_name(video_path)
-    imgs, vids = ret
-    video_landmarks = landmarker.combine_vid_img_lm478_to_lm68(imgs, vids)
-    # json格式
-    json_data = []
-    for pts in video_landmarks.astype(int):
-        json_data.append(pts.tolist())
-    with open(save_path, "w") as f:
-        json.dump(json_data, f)
+def save_video_landmarks(video_path, save_path, cache=None, workers=None):
+    source = VideoFrameSource(video_path)
+    with MediapipeLandmarker(cache=cache) as landmarker:
+        # IMAGE mode detection on a thread pool, VIDEO mode keeps its own thread
+        imgs, vids, valid = landmarker.extract_lm478_from_video_name(video_path, return_valid=True, workers=workers)
+        video_landmarks = landmarker.combine_vid_img_lm478_to_lm68(imgs, vids)
+    # binary landmark track, memory-mapped when read back
+    save_landmark_track(save_path, video_landmarks, "lm68", source.fps or 25, (source.width, source.height), valid)
 
 
 if __name__ == '__main__':
     # save_image_landmarks("mouth.jpg", "mouth.jpg.txt")
     # save_image_landmarks("inference.jpg", "inference.jpg.txt")
-    save_video_landmarks("mouth.mp4", "mouth.mp4.txt")
-    save_video_landmarks("inference.mp4", "inference.mp4.txt")
+    # reused driver videos skip detection on later runs
+    cache = LandmarkCache("landmark_cache", max_bytes=2 * 1024 ** 3)
+    save_video_landmarks("mouth.mp4", "mouth.mp4.lmk", cache, workers=os.cpu_count())
+    save_video_landmarks("inference.mp4", "inference.mp4.lmk", cache, workers=os.cpu_count())
+    print(cache.stats())
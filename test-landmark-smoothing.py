@@ -0,0 +1,33 @@
+import json
+import time
+
+from utils.face_landmarker import MediapipeLandmarker
+from utils.frame_source import VideoFrameSource
+from utils.landmark_smoothing import compare_landmark_tracks
+from utils.landmark_tracking import source_counts
+
+
+def compare_modes(video_path, smoothing=None, keyframe_interval=5):
+    results = {}
+    with MediapipeLandmarker() as landmarker:
+        for mode in ("dual", "single", "keyframe"):
+            start = time.perf_counter()
+            imgs, vids, source = landmarker.extract_lm478_from_frames(VideoFrameSource(video_path), anti_smooth_factor=2,
+                                                                      mode=mode,
+                                                                      smoothing=smoothing,
+                                                                      keyframe_interval=keyframe_interval,
+                                                                      return_source=True)
+            elapsed = time.perf_counter() - start
+            # the track the swap sees: mouth and eyes from IMAGE mode, the rest from VIDEO mode
+            results[mode] = landmarker.combine_vid_img_lm478_to_lm478(imgs, vids)
+            print(f"{mode}: {len(imgs)} frames in {elapsed:.2f}s, {len(imgs) / elapsed:.1f} fps, "
+                  f"{source_counts(source)}")
+    return {mode: compare_landmark_tracks(results["dual"], results[mode]) for mode in ("single", "keyframe")}
+
+
+if __name__ == '__main__':
+    # single-pass detection plus per-region Savitzky-Golay smoothing, and detection every 5th frame with
+    # optical flow in between, both against the dual IMAGE+VIDEO pass
+    report = compare_modes("inference.mp4", smoothing={"mouth": (5, 3), "eyes": (5, 3), "rest": (11, 2)},
+                           keyframe_interval=5)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,265 @@
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils.face_swap_utils import face_swap_frames
+from utils.frame_source import VideoFrameSource
+from utils.landmark_io import load_landmark_track, save_landmark_track
+from utils.segment_swap import concat_segments
+from utils.video_util import FFmpegWriter, pick_encoder
+
+# per-job options and their defaults, a manifest can set them per job or under "defaults"
+JOB_DEFAULTS = {
+    "chunk_frames": 500,
+    "fps": 25,
+    "anti_smooth_factor": 2,
+    "landmark_mode": "dual",
+    "landmark_workers": None,
+    "landmark_cache": None,
+    "blend_mode": "normal",
+    "motion_threshold": None,
+    "audio": None,
+    "encoder_options": None,
+    "work_dir": None,
+    "keep_work_dir": False,
+}
+
+
+def load_manifest(path):
+    """
+    Manifest: a json list of jobs, or {"defaults": {...}, "jobs": [...]}.
+    A job has "source", "target" and "output" video paths plus any of JOB_DEFAULTS, relative paths are
+    taken relative to the manifest.
+    return: list of complete job dicts
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {"jobs": manifest}
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for entry in manifest["jobs"]:
+        job = {**JOB_DEFAULTS, **manifest.get("defaults", {}), **entry}
+        missing = [key for key in ("source", "target", "output") if key not in job]
+        if missing:
+            raise ValueError(f"manifest job {entry} has no {', '.join(missing)}")
+        for key in ("source", "target", "output", "audio", "work_dir", "landmark_cache"):
+            if job[key] is not None:
+                job[key] = os.path.join(base, job[key])
+        jobs.append(job)
+    return jobs
+
+
+def _write_atomic_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _job_settings(job):
+    settings = {key: job[key] for key in ("source", "target", "chunk_frames", "fps", "anti_smooth_factor",
+                                          "landmark_mode", "blend_mode", "motion_threshold", "encoder_options")}
+    # compared with the copy read back from state.json
+    return json.loads(json.dumps(settings))
+
+
+def _job_done(job, work_dir):
+    # output on disk and, with a kept work_dir, written by a run with the job's current settings and audio
+    if not os.path.exists(job["output"]):
+        return False
+    path = os.path.join(work_dir, "state.json")
+    if not os.path.exists(work_dir):
+        return True
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        state = json.load(f)
+    return state.get("completed", False) and state["settings"] == _job_settings(job) and \
+        state.get("audio") == job["audio"]
+
+
+def _job_state(job, work_dir):
+    """
+    Settings every chunk of a job has to share, fixed on the first run and read back on a resume.
+    A changed manifest entry starts the job over.
+    """
+    path = os.path.join(work_dir, "state.json")
+    settings = _job_settings(job)
+    if os.path.exists(path):
+        with open(path) as f:
+            state = json.load(f)
+        if state["settings"] == settings:
+            if state.get("completed"):
+                # the output is rewritten, it only counts as done again after the concat
+                state["completed"] = False
+                _write_atomic_json(path, state)
+            return state
+        print(f"job settings changed, starting {job['output']} over")
+        shutil.rmtree(work_dir)
+        os.makedirs(work_dir)
+    encoder_options = dict(job["encoder_options"] or {})
+    # the chunks are joined by stream copy, they all need the same codec
+    encoder_options.setdefault("codec", pick_encoder())
+    state = {"settings": settings, "encoder_options": encoder_options}
+    _write_atomic_json(path, state)
+    return state
+
+
+def _landmark_track(job, work_dir, side, landmarker):
+    """
+    68 point landmarks of one side of a job, extracted once and kept in work_dir.
+    return: (track path, whether it was extracted now)
+    """
+    path = os.path.join(work_dir, f"{side}.lmk")
+    if os.path.exists(path):
+        return path, False
+    video = job[side]
+    imgs, vids, valid = landmarker.extract_lm478_from_video_name(video, job["fps"], job["anti_smooth_factor"],
+                                                                 return_valid=True, mode=job["landmark_mode"],
+                                                                 workers=job["landmark_workers"])
+    frames = VideoFrameSource(video)
+    tmp_path = path + ".part.lmk"
+    save_landmark_track(tmp_path, landmarker.combine_vid_img_lm478_to_lm68(imgs, vids), "lm68", frames.fps or 25,
+                        (frames.width, frames.height), valid)
+    os.replace(tmp_path, path)
+    return path, True
+
+
+def _swap_chunk(job, state, chunk_path, start, stop, source_lm, target_lm):
+    source_frames = VideoFrameSource(job["source"], start=start, stop=stop)
+    target_frames = VideoFrameSource(job["target"], start=start, stop=stop)
+    tmp_path = chunk_path + ".part.mp4"
+    count = 0
+    with FFmpegWriter(tmp_path, target_frames.width, target_frames.height, target_frames.fps or 25,
+                      **state["encoder_options"]) as writer:
+        for result in face_swap_frames(source_frames, target_frames, source_lm[start:stop], target_lm[start:stop],
+                                       job["blend_mode"], job["motion_threshold"]):
+            writer.write(result)
+            count += 1
+    os.replace(tmp_path, chunk_path)
+    return count
+
+
+def run_batch_job(job):
+    """
+    One manifest job: landmarks of both videos, then the face swap in chunks of chunk_frames frames,
+    each encoded to its own file, then the chunks are joined by stream copy with the audio muxed in.
+    Landmark tracks and finished chunks are checkpoints in the job's work_dir (default output + ".batch"),
+    an interrupted job picks up at the first chunk that is not on disk. A finished job is marked completed in
+    the work_dir's state.json, with keep_work_dir a rerun with the same settings skips it.
+    return: per-job report with frame counts and seconds per stage
+    """
+    from utils.face_landmarker import MediapipeLandmarker
+    from utils.landmark_cache import LandmarkCache
+
+    start_time = time.perf_counter()
+    report = {"output": job["output"], "status": "ok", "frames": 0, "chunks": 0, "chunks_resumed": 0,
+              "landmark_seconds": 0.0, "swap_seconds": 0.0, "concat_seconds": 0.0}
+    work_dir = job["work_dir"] or job["output"] + ".batch"
+    if _job_done(job, work_dir):
+        return {"output": job["output"], "status": "done", "error": "output exists, skipped"}
+    os.makedirs(work_dir, exist_ok=True)
+    state = _job_state(job, work_dir)
+
+    stage_start = time.perf_counter()
+    cache = LandmarkCache(job["landmark_cache"]) if job["landmark_cache"] else None
+    with MediapipeLandmarker(cache=cache) as landmarker:
+        tracks = {side: _landmark_track(job, work_dir, side, landmarker) for side in ("source", "target")}
+    report["landmarks_resumed"] = sum(not extracted for _, extracted in tracks.values())
+    report["landmark_seconds"] = round(time.perf_counter() - stage_start, 2)
+
+    source_lm = load_landmark_track(tracks["source"][0])
+    target_lm = load_landmark_track(tracks["target"][0])
+    num_frames = min(len(source_lm), len(target_lm), len(VideoFrameSource(job["source"])),
+                     len(VideoFrameSource(job["target"])))
+    chunk_frames = max(1, int(job["chunk_frames"]))
+    chunk_paths = []
+    stage_start = time.perf_counter()
+    for i, start in enumerate(range(0, num_frames, chunk_frames)):
+        chunk_path = os.path.join(work_dir, f"chunk_{i:05d}.mp4")
+        chunk_paths.append(chunk_path)
+        if os.path.exists(chunk_path):
+            report["chunks_resumed"] += 1
+            continue
+        report["frames"] += _swap_chunk(job, state, chunk_path, start, min(start + chunk_frames, num_frames),
+                                        source_lm, target_lm)
+    report["chunks"] = len(chunk_paths)
+    report["swap_seconds"] = round(time.perf_counter() - stage_start, 2)
+
+    stage_start = time.perf_counter()
+    concat_segments(chunk_paths, job["output"], job["audio"])
+    report["concat_seconds"] = round(time.perf_counter() - stage_start, 2)
+    state.update(completed=True, audio=job["audio"])
+    _write_atomic_json(os.path.join(work_dir, "state.json"), state)
+    if not job["keep_work_dir"]:
+        shutil.rmtree(work_dir)
+
+    report["total_frames"] = num_frames
+    report["seconds"] = round(time.perf_counter() - start_time, 2)
+    # throughput of the frames processed in this run, resumed chunks cost nothing
+    report["fps"] = round(report["frames"] / report["swap_seconds"], 2) if report["swap_seconds"] else None
+    report["end_to_end_fps"] = round(num_frames / report["seconds"], 2) if report["seconds"] else None
+    return report
+
+
+def _run_job_safely(job):
+    # one failing job must not take the rest of the batch down
+    try:
+        return run_batch_job(job)
+    except Exception as e:
+        return {"output": job["output"], "status": "failed", "error": f"{type(e).__name__}: {e}"}
+
+
+def format_summary(reports):
+    header = f"{'output':<40} {'status':<7} {'frames':>8} {'resumed':>8} {'lmk s':>8} {'swap s':>8} {'fps':>8} " \
+             f"{'total s':>8}"
+    lines = [header, "-" * len(header)]
+    for r in reports:
+        if r["status"] != "ok":
+            lines.append(f"{r['output'][-40:]:<40} {r['status']:<7} {r['error']}")
+            continue
+        resumed = f"{r['chunks_resumed']}/{r['chunks']}"
+        lines.append(f"{r['output'][-40:]:<40} {r['status']:<7} {r['frames']:>8} {resumed:>8} "
+                     f"{r['landmark_seconds']:>8.1f} {r['swap_seconds']:>8.1f} {r['fps'] or 0:>8.1f} "
+                     f"{r['seconds']:>8.1f}")
+    ran = [r for r in reports if r["status"] == "ok"]
+    skipped = sum(r["status"] == "done" for r in reports)
+    failed = len(reports) - len(ran) - skipped
+    frames = sum(r["frames"] for r in ran)
+    lines.append(f"{len(ran)} jobs ran, {skipped} already done, {failed} failed, {frames} frames swapped in this run")
+    return "\n".join(lines)
+
+
+def run_batch(manifest_path, concurrency=2, summary_path=None):
+    """
+    Run every job of a manifest, at most concurrency jobs at a time, each in its own process.
+    Rerunning the same manifest skips finished outputs and resumes interrupted jobs from their checkpoints.
+    summary_path: per-job reports as json, default manifest_path + ".summary.json"
+    return: per-job reports in manifest order
+    """
+    jobs = load_manifest(manifest_path)
+    reports = [None] * len(jobs)
+    pending = []
+    for i, job in enumerate(jobs):
+        work_dir = job["work_dir"] or job["output"] + ".batch"
+        if _job_done(job, work_dir):
+            reports[i] = {"output": job["output"], "status": "done", "error": "output exists, skipped"}
+        else:
+            pending.append(i)
+    if pending:
+        # spawn, mediapipe graphs do not survive a fork
+        with ProcessPoolExecutor(min(concurrency, len(pending)),
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {pool.submit(_run_job_safely, jobs[i]): i for i in pending}
+            for future in as_completed(futures):
+                report = future.result()
+                reports[futures[future]] = report
+                print(json.dumps(report))
+    summary = format_summary(reports)
+    print(summary)
+    _write_atomic_json(summary_path or manifest_path + ".summary.json", reports)
+    return reports
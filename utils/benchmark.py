@@ -0,0 +1,226 @@
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from utils.face_swap_utils import (calculate_delaunay_triangles, remove_specific_elements, warp_triangle, blend_face,
+                                   face_roi, face_swap, DelaunayCache, FaceSwapper)
+from utils.frame_source import VideoFrameSource
+from utils.landmark_io import load_landmark_track, save_landmark_track
+from utils.mesh_warp import MeshWarper
+from utils.video_util import FFmpegWriter
+
+STAGES = ("decode", "landmarks", "triangulate", "triangulate_cached", "warp_triangle", "mesh_warp", "seamless_clone",
+          "face_swap", "face_swap_reuse", "encode")
+
+
+def synthetic_face_landmarks(cx, cy, size, mouth_open=0.0):
+    """
+    68 point landmarks in the usual layout (jaw, brows, nose, eyes, lips) of a frontal face centered at cx, cy
+    """
+    pts = []
+    # jaw 0-16
+    for t in np.linspace(0.05 * np.pi, 0.95 * np.pi, 17):
+        pts.append((cx - size * np.cos(t), cy + 0.2 * size + 0.8 * size * np.sin(t)))
+    # brows 17-26
+    for x in np.concatenate([np.linspace(-0.8, -0.2, 5), np.linspace(0.2, 0.8, 5)]):
+        pts.append((cx + size * x, cy - 0.55 * size - 0.1 * size * np.cos(3 * x)))
+    # nose bridge 27-30 and bottom 31-35
+    for y in np.linspace(-0.35, 0.1, 4):
+        pts.append((cx, cy + size * y))
+    for x in np.linspace(-0.2, 0.2, 5):
+        pts.append((cx + size * x, cy + 0.2 * size))
+    # eyes 36-47
+    for ex in (-0.45, 0.45):
+        for a in np.linspace(0, 2 * np.pi, 7)[:-1]:
+            pts.append((cx + size * (ex - 0.15 * np.cos(a)), cy - 0.3 * size - 0.06 * size * np.sin(a)))
+    # outer lip 48-59 and inner lip 60-67
+    mouth_y = cy + 0.55 * size
+    for a in np.linspace(0, 2 * np.pi, 13)[:-1]:
+        pts.append((cx - 0.35 * size * np.cos(a), mouth_y - (0.1 + mouth_open) * size * np.sin(a)))
+    for a in np.linspace(0, 2 * np.pi, 9)[:-1]:
+        pts.append((cx - 0.25 * size * np.cos(a), mouth_y - (0.03 + mouth_open) * size * np.sin(a)))
+    return np.float32(pts)
+
+
+def draw_synthetic_face(frame, lm68, skin=(205, 160, 130)):
+    cv2.fillConvexPoly(frame, np.int32(cv2.convexHull(np.int32(lm68[:27]))), skin, cv2.LINE_AA)
+    for brow in (lm68[17:22], lm68[22:27]):
+        cv2.polylines(frame, [np.int32(brow)], False, (70, 50, 40), 3, cv2.LINE_AA)
+    cv2.polylines(frame, [np.int32(lm68[27:31])], False, (160, 110, 90), 2, cv2.LINE_AA)
+    cv2.polylines(frame, [np.int32(lm68[31:36])], False, (160, 110, 90), 2, cv2.LINE_AA)
+    for eye in (lm68[36:42], lm68[42:48]):
+        cv2.fillPoly(frame, [np.int32(eye)], (250, 250, 250), cv2.LINE_AA)
+        cv2.circle(frame, tuple(np.int32(eye.mean(axis=0))), 3, (40, 30, 30), -1, cv2.LINE_AA)
+    cv2.fillPoly(frame, [np.int32(lm68[48:60])], (180, 60, 70), cv2.LINE_AA)
+    cv2.fillPoly(frame, [np.int32(lm68[60:68])], (60, 20, 30), cv2.LINE_AA)
+    return frame
+
+
+def make_synthetic_clip(video_path, width, height, num_frames, seed=0, fps=25):
+    """
+    Render a clip of a drawn, moving and talking face over a textured background.
+    The exact 68 point landmarks are saved next to it as video_path + ".lmk".
+    return: landmark track path
+    """
+    rng = np.random.default_rng(seed)
+    background = cv2.resize((rng.random((height // 16 + 1, width // 16 + 1, 3)) * 255).astype(np.uint8),
+                            (width, height), interpolation=cv2.INTER_CUBIC)
+    size = 0.22 * min(width, height)
+    landmarks = np.zeros((num_frames, 68, 2), dtype=np.float32)
+    with FFmpegWriter(video_path, width, height, fps) as writer:
+        for i in range(num_frames):
+            cx = width / 2 + 0.1 * width * np.sin(2 * np.pi * i / 90)
+            cy = height / 2 + 0.05 * height * np.sin(2 * np.pi * i / 60)
+            lm68 = synthetic_face_landmarks(cx, cy, size * (1 + 0.05 * np.sin(2 * np.pi * i / 120)),
+                                            mouth_open=0.08 * (1 + np.sin(2 * np.pi * i / 8)))
+            landmarks[i] = lm68
+            writer.write(draw_synthetic_face(background.copy(), lm68))
+    landmarks_path = video_path + ".lmk"
+    save_landmark_track(landmarks_path, landmarks, "lm68", fps, (width, height))
+    return landmarks_path
+
+
+def _swap_inputs(source_clip, target_clip):
+    """
+    yield per frame: source / target frame, 68 point source / target landmarks, the filtered points, hull index, rect
+    """
+    source_lm = load_landmark_track(source_clip + ".lmk")
+    target_lm = load_landmark_track(target_clip + ".lmk")
+    for img1, img2, lm1, lm2 in zip(VideoFrameSource(source_clip), VideoFrameSource(target_clip), source_lm, target_lm):
+        points1 = np.asarray(remove_specific_elements(lm1), dtype=np.float32)
+        points2 = np.asarray(remove_specific_elements(lm2), dtype=np.float32)
+        hull_index = cv2.convexHull(points2, returnPoints=False).reshape(-1)
+        rect = (0, 0, img2.shape[1], img2.shape[0])
+        yield img1, img2, lm1, lm2, points1, points2, hull_index, rect
+
+
+def _time_stage(stage, source_clip, target_clip, work_dir):
+    """
+    return: (frames processed, seconds spent inside the stage itself)
+    """
+    elapsed = 0.0
+    frames = 0
+    if stage == "decode":
+        start = time.perf_counter()
+        for _ in VideoFrameSource(target_clip):
+            frames += 1
+        return frames, time.perf_counter() - start
+
+    if stage == "landmarks":
+        from utils.face_landmarker import MediapipeLandmarker
+        with MediapipeLandmarker() as landmarker:
+            landmarker.img_landmarker
+            start = time.perf_counter()
+            img_lm478, _ = landmarker.extract_lm478_from_frames(VideoFrameSource(target_clip))
+            return len(img_lm478), time.perf_counter() - start
+
+    if stage == "encode":
+        source = VideoFrameSource(target_clip)
+        writer = FFmpegWriter(os.path.join(work_dir, "encode.mp4"), source.width, source.height, source.fps or 25)
+        for frame in source:
+            start = time.perf_counter()
+            writer.write(frame)
+            elapsed += time.perf_counter() - start
+            frames += 1
+        start = time.perf_counter()
+        writer.close()
+        return frames, elapsed + time.perf_counter() - start
+
+    tri_cache = DelaunayCache()
+    warper = MeshWarper()
+    swapper = FaceSwapper(motion_threshold=1.0)
+    for img1, img2, lm1, lm2, points1, points2, hull_index, rect in _swap_inputs(source_clip, target_clip):
+        start = time.perf_counter()
+        if stage == "triangulate":
+            calculate_delaunay_triangles(rect, points2[hull_index])
+        elif stage == "triangulate_cached":
+            tri_cache.get(rect, points2, hull_index)
+        elif stage == "warp_triangle":
+            dt = tri_cache.get(rect, points2, hull_index)
+            start = time.perf_counter()
+            warped = np.copy(img2)
+            for tri in dt:
+                warp_triangle(img1, warped, points1[tri], points2[tri])
+        elif stage == "mesh_warp":
+            dt = tri_cache.get(rect, points2, hull_index)
+            start = time.perf_counter()
+            warper.warp(img1, np.copy(img2), points1[dt], points2[dt])
+        elif stage == "seamless_clone":
+            # the same ROI blend face_swap does, on an already warped face
+            hull2 = points2[hull_index]
+            r = cv2.boundingRect(hull2)
+            x0, y0, x1, y1 = face_roi(r, img2.shape)
+            dt = tri_cache.get(rect, points2, hull_index)
+            warped = warper.warp(img1, np.copy(img2), points1[dt], points2[dt])[y0:y1, x0:x1]
+            mask = np.zeros(warped.shape[:2], dtype=np.uint8)
+            cv2.fillConvexPoly(mask, np.int32(hull2 - np.float32([x0, y0])), 255)
+            start = time.perf_counter()
+            blend_face(warped, img2[y0:y1, x0:x1], mask, (r[0] - x0 + r[2] // 2, r[1] - y0 + r[3] // 2))
+        elif stage == "face_swap":
+            face_swap(img1, img2, lm1, lm2, tri_cache, warper)
+        elif stage == "face_swap_reuse":
+            swapper.swap(img1, img2, lm1, lm2)
+        else:
+            raise ValueError(f"unknown benchmark stage {stage}")
+        elapsed += time.perf_counter() - start
+        frames += 1
+    return frames, elapsed
+
+
+def run_stage(stage, source_clip, target_clip, work_dir):
+    # runs in a fresh process, so ru_maxrss is the peak of this stage alone
+    try:
+        frames, elapsed = _time_stage(stage, source_clip, target_clip, work_dir)
+        result = {"frames": frames, "seconds": round(elapsed, 4), "fps": round(frames / elapsed, 2) if elapsed else None}
+    except Exception as e:
+        result = {"error": f"{type(e).__name__}: {e}"}
+    result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(output_json, resolutions=((640, 360), (1280, 720), (1920, 1080)), lengths=(50,), stages=STAGES,
+                   work_dir="benchmark_clips"):
+    """
+    Time every stage on synthetic clips of each resolution and length, each stage in its own process.
+    Results go to output_json so runs on different commits can be compared.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    for width, height in resolutions:
+        for num_frames in lengths:
+            source_clip = os.path.join(work_dir, f"source_{width}x{height}_{num_frames}.mp4")
+            target_clip = os.path.join(work_dir, f"target_{width}x{height}_{num_frames}.mp4")
+            if not os.path.exists(source_clip + ".lmk"):
+                make_synthetic_clip(source_clip, width, height, num_frames, seed=1)
+            if not os.path.exists(target_clip + ".lmk"):
+                make_synthetic_clip(target_clip, width, height, num_frames, seed=2)
+            for stage in stages:
+                with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                    result = pool.submit(run_stage, stage, source_clip, target_clip, work_dir).result()
+                result.update({"stage": stage, "resolution": f"{width}x{height}", "length": num_frames})
+                print(json.dumps(result))
+                results.append(result)
+    report = {
+        "revision": git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"platform": platform.platform(), "cpu_count": os.cpu_count(), "opencv": cv2.__version__},
+        "results": results,
+    }
+    with open(output_json, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
@@ -1,4 +1,7 @@
-import json
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import mediapipe as mp
 from mediapipe.tasks import python
@@ -6,192 +9,86 @@ from mediapipe.tasks.python import vision
 import numpy as np
 import cv2
 import os
-import copy
 from tqdm import tqdm
 
-# simplified mediapipe ldm at https://github.com/k-m-irfan/simplified_mediapipe_face_landmarks
-index_lm141_from_lm478 = ([70, 63, 105, 66, 107, 55, 65, 52, 53, 46]
-                          + [300, 293, 334, 296, 336, 285, 295, 282, 283, 276]
-                          + [33, 246, 161, 160, 159, 158, 157, 173, 133, 155, 154, 153, 145, 144, 163, 7]
-                          + [263, 466, 388, 387, 386, 385, 384, 398, 362, 382, 381, 380, 374, 373, 390, 249]
-                          + [78, 191, 80, 81, 82, 13, 312, 311, 310, 415, 308, 324, 318, 402, 317, 14, 87, 178, 88, 95]
-                          + [61, 185, 40, 39, 37, 0, 267, 269, 270, 409, 291, 375, 321, 405, 314, 17, 84, 181, 91, 146]
-                          + [10, 338, 297, 332, 284, 251, 389, 356, 454, 323, 361, 288, 397, 365, 379, 378, 400, 377,
-                             152, 148, 176, 149, 150, 136,
-                             172, 58, 132, 93, 234, 127, 162, 21, 54, 103, 67, 109]
-                          + [468, 469, 470, 471, 472]
-                          + [473, 474, 475, 476, 477]
-                          + [64, 4, 294])
-# lm141 without iris
-index_lm131_from_lm478 = ([70, 63, 105, 66, 107, 55, 65, 52, 53, 46]
-                          + [300, 293, 334, 296, 336, 285, 295, 282, 283, 276]
-                          + [33, 246, 161, 160, 159, 158, 157, 173, 133, 155, 154, 153, 145, 144, 163, 7]
-                          + [263, 466, 388, 387, 386, 385, 384, 398, 362, 382, 381, 380, 374, 373, 390, 249]
-                          + [78, 191, 80, 81, 82, 13, 312, 311, 310, 415, 308, 324, 318, 402, 317, 14, 87, 178, 88, 95]
-                          + [61, 185, 40, 39, 37, 0, 267, 269, 270, 409, 291, 375, 321, 405, 314, 17, 84, 181, 91, 146]
-                          + [10, 338, 297, 332, 284, 251, 389, 356, 454, 323, 361, 288, 397, 365, 379, 378, 400, 377,
-                             152, 148, 176, 149, 150, 136,
-                             172, 58, 132, 93, 234, 127, 162, 21, 54, 103, 67, 109]
-                          + [64, 4, 294])
-
-# face alignment lm68
-index_lm68_from_lm478 = [127, 234, 93, 132, 58, 136, 150, 176, 152, 400, 379, 365, 288, 361, 323, 454, 356, 70, 63, 105,
-                         66, 107, 336, 296, 334, 293,
-                         300, 168, 197, 5, 4, 75, 97, 2, 326, 305, 33, 160, 158, 133, 153, 144, 362, 385, 387, 263, 373,
-                         380, 61, 40, 37, 0, 267, 270,
-                         291, 321, 314, 17, 84, 91, 78, 81, 13, 311, 308, 402, 14, 178]
-# used for weights for key parts
-unmatch_mask_from_lm478 = [93, 127, 132, 234, 323, 356, 361, 454]
-index_eye_from_lm478 = ([33, 246, 161, 160, 159, 158, 157, 173, 133, 155, 154, 153, 145, 144, 163, 7]
-                        + [263, 466, 388, 387, 386, 385, 384, 398, 362, 382, 381, 380, 374, 373, 390, 249])
-index_innerlip_from_lm478 = [78, 191, 80, 81, 82, 13, 312, 311, 310, 415, 308, 324, 318, 402, 317, 14, 87, 178, 88, 95]
-index_outerlip_from_lm478 = [61, 185, 40, 39, 37, 0, 267, 269, 270, 409, 291, 375, 321, 405, 314, 17, 84, 181, 91, 146]
-index_withinmouth_from_lm478 = ([76, 62]
-                                + [184, 183, 74, 72, 73, 41, 72, 38, 11, 12, 302, 268, 303, 271, 304, 272, 408, 407]
-                                + [292, 306]
-                                + [325, 307, 319, 320, 403, 404, 316, 315, 15, 16, 86, 85, 179, 180, 89, 90, 96, 77])
-index_mouth_from_lm478 = index_innerlip_from_lm478 + index_outerlip_from_lm478 + index_withinmouth_from_lm478
-
-index_yaw_from_lm68 = list(range(0, 17))
-index_brow_from_lm68 = list(range(17, 27))
-index_nose_from_lm68 = list(range(27, 36))
-index_eye_from_lm68 = list(range(36, 48))
-index_mouth_from_lm68 = list(range(48, 68))
+from utils.frame_source import VideoFrameSource
+from utils.landmark_io import LandmarkTrack, write_landmarks
+from utils.landmark_smoothing import DEFAULT_SMOOTHING, smooth_lm478_track
+from utils.landmark_tracking import (FlowTracker, interpolate_failed, SOURCE_FAILED, SOURCE_DETECTED,
+                                     SOURCE_TRACKED)
+from utils.landmark_layouts import (index_lm141_from_lm478, index_lm131_from_lm478, index_lm68_from_lm478,
+                                    unmatch_mask_from_lm478, index_eye_from_lm478, index_innerlip_from_lm478,
+                                    index_outerlip_from_lm478, index_withinmouth_from_lm478, index_mouth_from_lm478,
+                                    index_yaw_from_lm68, index_brow_from_lm68, index_nose_from_lm68,
+                                    index_eye_from_lm68, index_mouth_from_lm68, HALF_FACE_MASK, HOMOLM,
+                                    half_face_layout, combine_lm478_to_lm68, combine_lm478)
+from utils.metrics import metrics
 
 
 def read_video_to_frames(video_name):
-    frames = []
-    cap = cv2.VideoCapture(video_name)
-    if not cap.isOpened():
-        raise IOError("Cannot open video file {}".format(video_name))
-    cnt = 0
-    while True:
-        ret, frame_bgr = cap.read()
-        if not ret:
-            print("Reached the end of the video or failed to read the frame.")
-            break
-        if frame_bgr is None:
-            break
-        # too large may cause error, so make sure the face position is in range of 1300x900
-        height = frame_bgr.shape[0]
-        width = frame_bgr.shape[1]
-        if height > 1300:
-            frame_bgr = frame_bgr[:1300, :, :]
-        if width > 900:
-            frame_bgr = frame_bgr[:, :900, :]
-        frames.append(frame_bgr)
-        cnt += 1
-    cap.release()
+    frames = VideoFrameSource(video_name).read_all()
     print('read {} frames'.format(len(frames)))
-    frames = np.stack(frames)
-    frames = np.flip(frames, -1)  # BGR ==> RGB
     return frames
 
 
+def roi_from_landmarks(landmarks, margin=0.25):
+    """
+    Square region around landmarks [N, 2], expanded by margin of the face size on each side.
+    return: (x0, y0, side) in pixels, may extend past the frame
+    """
+    x_min, y_min = landmarks.min(axis=0)
+    x_max, y_max = landmarks.max(axis=0)
+    side = max(x_max - x_min, y_max - y_min, 1.0) * (1 + 2 * margin)
+    return (x_min + x_max - side) / 2, (y_min + y_max - side) / 2, side
+
+
 def mv_pts(pts, x=0, y=0):
     return [int(round(pts[0] + x)), int(round(pts[1] + y))]
 
 
 def get_half_face_landmarks_list(landmark, padding=2):
-    half_face_landmarks_list = []
-    for i in range(0, 68):
-        if 1 < i < 15:
-            if i in [2, 3, 4, 5, 6]:
-                half_face_landmarks_list.append([landmark[i][0] + padding, landmark[i][1]])
-            elif i in [10, 11, 12, 13, 14]:
-                half_face_landmarks_list.append([landmark[i][0] - padding, landmark[i][1]])
-            else:
-                half_face_landmarks_list.append(landmark[i])
-    half_face_landmarks_list.append([landmark[35][0] + padding, landmark[14][1]])
-    half_face_landmarks_list.append([landmark[35][0] + padding, landmark[33][1] + padding])
-    half_face_landmarks_list.append([landmark[31][0] - padding, landmark[33][1] + padding])
-    half_face_landmarks_list.append([landmark[31][0] - padding, landmark[2][1]])
-    return half_face_landmarks_list
+    return half_face_layout(padding).to_json(landmark)
 
 
 def convert68_to_homolm(landmarks):
-    homo_landmarks = []
-    for i in range(0, 68):
-        if 1 < i < 15:
-            if i in [2, 3, 4, 5, 6]:
-                homo_landmarks.append([landmarks[i][0] + 2, landmarks[i][1]])
-            elif i in [10, 11, 12, 13, 14]:
-                homo_landmarks.append([landmarks[i][0] - 2, landmarks[i][1]])
-            else:
-                homo_landmarks.append(landmarks[i])
-    homo_landmarks.append([landmarks[35][0], landmarks[35][1]])
-    homo_landmarks.append([landmarks[29][0], landmarks[29][1]])
-    homo_landmarks.append([landmarks[31][0], landmarks[31][1]])
-    return homo_landmarks
-
-
-def save_homolm(landmarks, save_path):
-    data_list = []
-    for i, pts in enumerate(landmarks):
-        half_pts = convert68_to_homolm(pts)
-        for j, p in enumerate(half_pts):
-            half_pts[j] = [int(round(p[0])), int(round(p[1]))]
-        data_list.append(half_pts)
-    with open(save_path, 'w') as file_object:
-        json.dump(data_list, file_object)
-
-
-def save_half_face_landmarks(landmarks, save_path):
-    json_data = []
-    for i, pts in enumerate(landmarks):
-        half_pts = get_half_face_landmarks_list(pts)
-        for j, p in enumerate(half_pts):
-            half_pts[j] = [int(round(p[0])), int(round(p[1]))]
-        json_data.append(half_pts)
-    print(json_data)
-    with open(save_path, 'w') as file_object:
-        json.dump(json_data, file_object)
-
-
-def save_half_face_mask_landmarks(landmarks, save_path):
-    json_data = []
-    for i, pts in enumerate(landmarks):
-        half_pts = get_half_face_landmarks_list(pts)
-        for j, p in enumerate(half_pts):
-            if 0 <= j <= 4:
-                half_pts[j] = mv_pts(p, 5, 0)
-            elif 5 <= j <= 7:
-                if j == 5:
-                    half_pts[j] = mv_pts(p, 3, -3)
-                elif j == 6:
-                    half_pts[j] = mv_pts(p, 0, -3)
-                elif j == 7:
-                    half_pts[j] = mv_pts(p, -3, -3)
-            elif 8 <= j <= 12:
-                half_pts[j] = mv_pts(p, -5, 0)
-            else:
-                if j == 13:
-                    half_pts[j] = mv_pts(p, 3, 0)
-                if j == 14:
-                    half_pts[j] = mv_pts(p, 3, 3)
-                if j == 15:
-                    half_pts[j] = mv_pts(p, -3, 3)
-                if j == 16:
-                    half_pts[j] = mv_pts(p, -3, 0)
-        json_data.append(half_pts)
-    with open(save_path, 'w') as file_object:
-        json.dump(json_data, file_object)
-
-
-def save_full_face_landmarks(landmarks, save_path):
-    json_data = []
-    for i, pts in enumerate(landmarks):
-        half_pts = pts.tolist()
-        for j, p in enumerate(half_pts):
-            half_pts[j] = [int(round(p[0])), int(round(p[1]))]
-        json_data.append(half_pts)
-    print(json_data)
-    with open(save_path, 'w') as file_object:
-        json.dump(json_data, file_object)
+    return HOMOLM.to_json(landmarks)
+
+
+def save_homolm(landmarks, save_path, fps=25.0, frame_size=None):
+    write_landmarks(save_path, HOMOLM.apply(landmarks), "homolm", fps, frame_size)
+
+
+def save_half_face_landmarks(landmarks, save_path, fps=25.0, frame_size=None):
+    write_landmarks(save_path, half_face_layout().apply(landmarks), "half_face", fps, frame_size)
+
+
+def save_half_face_mask_landmarks(landmarks, save_path, fps=25.0, frame_size=None):
+    write_landmarks(save_path, HALF_FACE_MASK.apply(landmarks), "half_face_mask", fps, frame_size)
+
+
+def save_full_face_landmarks(landmarks, save_path, fps=25.0, frame_size=None):
+    write_landmarks(save_path, landmarks, None, fps, frame_size)
+
+
+def grow_buffer(buffer, capacity):
+    grown = np.zeros((capacity,) + buffer.shape[1:], dtype=buffer.dtype)
+    grown[:len(buffer)] = buffer
+    return grown
 
 
 class MediapipeLandmarker:
-    def __init__(self):
+    """
+    Owns long-lived mediapipe landmarkers, call close() or use it as a context manager to release them.
+    The IMAGE landmarker is created once and reused. A VIDEO landmarker tracks state across frames and
+    needs increasing timestamps, so each video stream gets its own one via new_video_stream().
+    max_detect_size: full frames are downscaled to this long side before detection
+    roi_size, roi_margin: inference size and margin of the face crop in tracking mode
+    cache: optional LandmarkCache, repeated videos with the same parameters then skip detection
+    IMAGE detection across a thread pool (workers=) gives every pool thread its own IMAGE landmarker,
+    pool and landmarkers are kept until close().
+    """
+
+    def __init__(self, max_detect_size=1280, roi_size=320, roi_margin=0.25, cache=None):
         model_path = 'utils/mp_feature_extractors/face_landmarker.task'
         if not os.path.exists(model_path):
             os.makedirs(os.path.dirname(model_path), exist_ok=True)
@@ -209,6 +106,128 @@ class MediapipeLandmarker:
                                                                running_mode=vision.RunningMode.VIDEO,
                                                                # IMAGE, VIDEO, LIVE_STREAM
                                                                num_faces=1)
+        self.max_detect_size = max_detect_size
+        self.roi_size = roi_size
+        self.roi_margin = roi_margin
+        self.cache = cache
+        self._img_landmarker = None
+        self._vid_landmarker = None
+        self._local = threading.local()
+        self._thread_landmarkers = []
+        self._thread_landmarkers_lock = threading.Lock()
+        self._image_pool = None
+        self._image_pool_workers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._img_landmarker is not None:
+            self._img_landmarker.close()
+            self._img_landmarker = None
+        if self._vid_landmarker is not None:
+            self._vid_landmarker.close()
+            self._vid_landmarker = None
+        self._close_image_pool()
+
+    def _close_image_pool(self):
+        # the pool threads are gone after shutdown, so are the only users of their landmarkers
+        if self._image_pool is not None:
+            self._image_pool.shutdown(wait=True)
+            self._image_pool = None
+        with self._thread_landmarkers_lock:
+            for landmarker in self._thread_landmarkers:
+                landmarker.close()
+            self._thread_landmarkers = []
+        self._local = threading.local()
+
+    def image_pool(self, workers):
+        """
+        Thread pool of IMAGE detection, kept across calls together with the landmarkers of its threads,
+        so repeated clips do not open new mediapipe graphs. A different worker count replaces it.
+        """
+        if self._image_pool is None or self._image_pool_workers != workers:
+            self._close_image_pool()
+            self._image_pool = ThreadPoolExecutor(workers, thread_name_prefix="landmarks-image")
+            self._image_pool_workers = workers
+        return self._image_pool
+
+    @property
+    def img_landmarker(self):
+        if self._img_landmarker is None:
+            self._img_landmarker = vision.FaceLandmarker.create_from_options(self.image_mode_options)
+        return self._img_landmarker
+
+    @property
+    def thread_img_landmarker(self):
+        # IMAGE landmarker of the calling thread, a graph is not shared between concurrent detections
+        landmarker = getattr(self._local, "img_landmarker", None)
+        if landmarker is None:
+            landmarker = vision.FaceLandmarker.create_from_options(self.image_mode_options)
+            self._local.img_landmarker = landmarker
+            with self._thread_landmarkers_lock:
+                self._thread_landmarkers.append(landmarker)
+        return landmarker
+
+    def new_video_stream(self):
+        if self._vid_landmarker is not None:
+            self._vid_landmarker.close()
+        self._vid_landmarker = vision.FaceLandmarker.create_from_options(self.video_mode_options)
+        return self._vid_landmarker
+
+    @staticmethod
+    def detect_into(landmarker, image, out, timestamp_ms=None):
+        """
+        Run one detection and write the landmarks in pixels into out [478, 2].
+        image: mp.Image, timestamp_ms: set for VIDEO mode landmarkers
+        return: whether a face was found, out is left untouched otherwise
+        """
+        if timestamp_ms is None:
+            result = landmarker.detect(image=image)
+        else:
+            result = landmarker.detect_for_video(image=image, timestamp_ms=timestamp_ms)
+        if not result.face_landmarks:
+            return False
+        landmarks = result.face_landmarks[0]
+        xy = np.fromiter((v for l in landmarks for v in (l.x, l.y)), dtype=np.float64, count=2 * len(landmarks))
+        np.multiply(xy.reshape(-1, 2)[:len(out)], (image.width, image.height), out=out)
+        return True
+
+    def detect_frame(self, landmarker, frame_rgb, out, box=None, timestamp_ms=None):
+        """
+        Detect on a full RGB frame and write the landmarks in full-frame pixels into out [478, 2].
+        box: (x0, y0, side) square region cropped and resized to roi_size,
+             None for the whole frame, downscaled to max_detect_size when larger
+        """
+        H, W = frame_rgb.shape[:2]
+        frame_rgb = np.asarray(frame_rgb, dtype=np.uint8)
+        if box is None:
+            x0, y0 = 0.0, 0.0
+            scale = min(1.0, self.max_detect_size / max(H, W))
+            if scale < 1.0:
+                dsize = (max(1, int(round(W * scale))), max(1, int(round(H * scale))))
+                data = cv2.resize(frame_rgb, dsize, interpolation=cv2.INTER_AREA)
+                scale = (dsize[0] / W, dsize[1] / H)
+            else:
+                data = np.ascontiguousarray(frame_rgb)
+        else:
+            x0, y0, side = box
+            scale = self.roi_size / side
+            warp_mat = np.float64([[scale, 0, -x0 * scale], [0, scale, -y0 * scale]])
+            data = cv2.warpAffine(frame_rgb, warp_mat, (self.roi_size, self.roi_size), flags=cv2.INTER_LINEAR,
+                                  borderMode=cv2.BORDER_CONSTANT)
+        image = mp.Image(image_format=mp.ImageFormat.SRGB, data=data)
+        with metrics.timer("detect"):
+            found = self.detect_into(landmarker, image, out, timestamp_ms)
+        if not found:
+            return False
+        # back to full-frame pixels
+        out /= scale
+        out += (x0, y0)
+        return True
 
     def extract_lm478_from_img_name(self, img_name):
         img = cv2.imread(img_name)
@@ -217,63 +236,297 @@ class MediapipeLandmarker:
         return img_lm478
 
     def extract_lm478_from_img(self, img):
-        img_landmarker = vision.FaceLandmarker.create_from_options(self.image_mode_options)
-        frame = mp.Image(image_format=mp.ImageFormat.SRGB, data=img.astype(np.uint8))
-        img_face_landmarker_result = img_landmarker.detect(image=frame)
-        img_ldm_i = img_face_landmarker_result.face_landmarks[0]
-        img_face_landmarks = np.array([[l.x, l.y, l.z] for l in img_ldm_i])
-        H, W, _ = img.shape
-        img_lm478 = np.array(img_face_landmarks)[:, :2] * np.array([W, H]).reshape([1, 2])  # [478, 2]
-        return img_lm478
+        img_lm478, valid = self.extract_lm478_from_images([img])
+        if not valid[0]:
+            raise ValueError("failed detect ldm in image")
+        return img_lm478[0]  # [478, 2]
+
+    def extract_lm478_from_images(self, images, num_images=None):
+        """
+        images: iterable of RGB uint8 images, sizes may differ
+        num_images: size hint for iterables without len
+        return: [B, 478, 2] landmarks in pixels, [B] valid mask, failed images are left at 0
+        """
+        if num_images is None and hasattr(images, '__len__'):
+            num_images = len(images)
+        lm478 = np.zeros((num_images or 16, 478, 2))
+        valid = np.zeros(len(lm478), dtype=bool)
+        count = 0
+        for img in images:
+            if count == len(lm478):
+                lm478, valid = grow_buffer(lm478, 2 * count), grow_buffer(valid, 2 * count)
+            valid[count] = self.detect_frame(self.img_landmarker, img, lm478[count])
+            count += 1
+        return lm478[:count], valid[:count]
 
-    def extract_lm478_from_video_name(self, video_name, fps=25, anti_smooth_factor=2):
-        frames = read_video_to_frames(video_name)
+    def extract_lm478_from_video_name(self, video_name, fps=25, anti_smooth_factor=2, return_valid=False,
+                                      track_roi=False, mode="dual", smoothing=None, keyframe_interval=5,
+                                      workers=None):
+        frames = VideoFrameSource(video_name)
         print(f"video length: {len(frames)}")
-        img_lm478, vid_lm478 = self.extract_lm478_from_frames(frames, fps, anti_smooth_factor)
+        if self.cache is None:
+            return self.extract_lm478_from_frames(frames, fps, anti_smooth_factor, return_valid=return_valid,
+                                                  track_roi=track_roi, mode=mode, smoothing=smoothing,
+                                                  keyframe_interval=keyframe_interval, workers=workers)
+
+        key = self.cache.key(video_name, scheme="lm478", fps=fps, anti_smooth_factor=anti_smooth_factor,
+                             track_roi=track_roi, max_detect_size=self.max_detect_size, roi_size=self.roi_size,
+                             roi_margin=self.roi_margin, mode=mode,
+                             smoothing=None if mode == "dual" else {**DEFAULT_SMOOTHING, **(smoothing or {})},
+                             keyframe_interval=keyframe_interval if mode == "keyframe" else None)
+        cached = self.cache.get(key, ("img", "vid"))
+        if cached is not None:
+            print(f"landmark cache hit for {video_name}")
+            img_lm478 = np.array(cached["img"].points, dtype=np.float64)
+            vid_lm478 = np.array(cached["vid"].points, dtype=np.float64)
+            valid = np.array(cached["img"].valid)
+        else:
+            img_lm478, vid_lm478, valid = self.extract_lm478_from_frames(frames, fps, anti_smooth_factor,
+                                                                         return_valid=True, track_roi=track_roi,
+                                                                         mode=mode, smoothing=smoothing,
+                                                                         keyframe_interval=keyframe_interval,
+                                                                         workers=workers)
+            frame_size = (frames.width, frames.height)
+            self.cache.put(key, {"img": LandmarkTrack(img_lm478, "lm478", frames.fps, frame_size, valid),
+                                 "vid": LandmarkTrack(vid_lm478, "lm478", frames.fps, frame_size, valid)})
+        if return_valid:
+            return img_lm478, vid_lm478, valid
         return img_lm478, vid_lm478
 
-    def extract_lm478_from_frames(self, frames, fps=25, anti_smooth_factor=20):
+    def extract_lm478_from_frames(self, frames, fps=25, anti_smooth_factor=20, total=None, return_valid=False,
+                                  track_roi=False, mode="dual", smoothing=None, keyframe_interval=5,
+                                  return_source=False, workers=None):
         """
-        frames: RGB, uint8
+        frames: RGB, uint8, an array or any iterable of frames (e.g. VideoFrameSource), consumed one at a time
         anti_smooth_factor: float, 对video模式的interval进行修改, 1代表无修改, 越大越接近image mode
+        return_valid: also return the per-frame mask of frames where both detections succeeded
+        track_roi: detect on a roi_size crop around the previous frame's face instead of the full frame,
+                   falling back to full-frame detection when tracking is lost
+        mode: "dual" runs the IMAGE and VIDEO landmarkers on every frame,
+              "single" runs the IMAGE landmarker once per frame and smooths the whole track per region afterwards,
+              "keyframe" is "single" with the detector only on keyframes, see iter_lm478_keyframes,
+              both returned tracks are then the smoothed one, so the combine_* methods keep working
+        smoothing: {region: (window, polyorder)} for mode "single", see landmark_smoothing.DEFAULT_SMOOTHING
+        keyframe_interval: frames between detections in mode "keyframe"
+        return_source: also return the per-frame landmark_tracking.SOURCE_* flags
+                       (detected / tracked / interpolated, failed for dual and single mode failures)
+        workers: run IMAGE detection of mode "dual" and "single" on a pool of this many threads, see
+                 extract_lm478_parallel. Ignored with track_roi and in mode "keyframe", where every
+                 detection depends on the frame before.
         """
-        img_mpldms = []
-        vid_mpldms = []
-        img_landmarker = vision.FaceLandmarker.create_from_options(self.image_mode_options)
-        vid_landmarker = vision.FaceLandmarker.create_from_options(self.video_mode_options)
-
-        for i in tqdm(range(len(frames))):
-            frame = mp.Image(image_format=mp.ImageFormat.SRGB, data=frames[i].astype(np.uint8))
-            img_face_landmarker_result = img_landmarker.detect(image=frame)
-            vid_face_landmarker_result = vid_landmarker.detect_for_video(image=frame, timestamp_ms=int(
-                (1000 / fps) * anti_smooth_factor * i))
+        if mode not in ("dual", "single", "keyframe"):
+            raise ValueError(f"unknown landmark mode {mode}")
+        if total is None and hasattr(frames, '__len__'):
+            total = len(frames)
+        if workers is not None and workers > 1 and mode != "keyframe" and not track_roi:
+            img_lm478, vid_lm478, ok = self.extract_lm478_parallel(frames, fps, anti_smooth_factor, total, workers,
+                                                                   single_pass=mode == "single")
+            source = np.where(ok, SOURCE_DETECTED, SOURCE_FAILED).astype(np.uint8)
+        else:
+            img_lm478 = np.zeros((total or 256, 478, 2))
+            vid_lm478 = np.zeros_like(img_lm478)
+            source = np.zeros(len(img_lm478), dtype=np.uint8)
+            if mode == "keyframe":
+                results = ((lm, lm, src) for lm, src in self.iter_lm478_keyframes(frames, keyframe_interval,
+                                                                                   track_roi=track_roi))
+            else:
+                results = ((img_lm, vid_lm, SOURCE_DETECTED if ok else SOURCE_FAILED)
+                           for img_lm, vid_lm, ok in self.iter_lm478_from_frames(frames, fps, anti_smooth_factor,
+                                                                                  track_roi,
+                                                                                  single_pass=mode == "single"))
+            count = 0
+            for i, (img_lm, vid_lm, src) in enumerate(tqdm(results, total=total)):
+                if i == len(source):
+                    img_lm478, vid_lm478, source = (grow_buffer(buf, 2 * i) for buf in (img_lm478, vid_lm478, source))
+                img_lm478[i], vid_lm478[i], source[i] = img_lm, vid_lm, src
+                count = i + 1
+            img_lm478, vid_lm478, source = img_lm478[:count], vid_lm478[:count], source[:count]  # [T, 478, 2]
+        valid = source != SOURCE_FAILED
+        if mode == "keyframe":
+            img_lm478, source = interpolate_failed(img_lm478, source)
+        if mode != "dual":
+            img_lm478 = vid_lm478 = smooth_lm478_track(img_lm478, smoothing, valid if mode == "single" else None)
+        outputs = (img_lm478, vid_lm478)
+        if return_valid:
+            outputs += (valid,)
+        if return_source:
+            outputs += (source,)
+        return outputs
+
+    def extract_lm478_parallel(self, frames, fps=25, anti_smooth_factor=20, total=None, workers=4,
+                               single_pass=False):
+        """
+        IMAGE detection of every frame across the image_pool of workers threads, each with its own landmarker,
+        written in place into a [T, 478, 2] buffer preallocated from total. mediapipe releases the GIL while
+        it infers, so the threads run in parallel. VIDEO detection needs its frames in order, it runs
+        sequentially on one more thread meanwhile. Frames are decoded on the calling thread and at most
+        2 * workers of them are in flight.
+        Failed detections take the previous frame's result like iter_lm478_from_frames does.
+        return: img_lm478 [T, 478, 2], vid_lm478 [T, 478, 2], valid [T]
+        """
+        capacity = total or 256
+        buffers = {"img": np.zeros((capacity, 478, 2)), "vid": np.zeros((capacity, 478, 2)),
+                   "img_ok": np.zeros(capacity, dtype=bool), "vid_ok": np.zeros(capacity, dtype=bool)}
+        # a buffer may only be swapped for a larger one while no detection writes into it
+        lock = threading.Lock()
+
+        def store(name, i, lm, ok):
+            with lock:
+                buffers[name][i] = lm
+                buffers[name + "_ok"][i] = ok
+
+        def detect_image(i, frame_rgb):
+            lm = np.zeros((478, 2))
+            store("img", i, lm, self.detect_frame(self.thread_img_landmarker, frame_rgb, lm))
+
+        video_frames = queue.Queue(maxsize=2 * workers)
+        video_errors = []
+
+        def detect_video():
             try:
-                img_ldm_i = img_face_landmarker_result.face_landmarks[0]
-                vid_ldm_i = vid_face_landmarker_result.face_landmarks[0]
-            except:
-                print(f"Warning: failed detect ldm in idx={i}, use previous frame results.")
-            img_face_landmarks = np.array([[l.x, l.y, l.z] for l in img_ldm_i])
-            vid_face_landmarks = np.array([[l.x, l.y, l.z] for l in vid_ldm_i])
-            img_mpldms.append(img_face_landmarks)
-            vid_mpldms.append(vid_face_landmarks)
-        img_lm478 = np.stack(img_mpldms)[..., :2]
-        vid_lm478 = np.stack(vid_mpldms)[..., :2]
-        bs, H, W, _ = frames.shape
-        img_lm478 = np.array(img_lm478)[..., :2] * np.array([W, H]).reshape([1, 1, 2])  # [T, 478, 2]
-        vid_lm478 = np.array(vid_lm478)[..., :2] * np.array([W, H]).reshape([1, 1, 2])  # [T, 478, 2]
-        return img_lm478, vid_lm478
+                vid_landmarker = self.new_video_stream()
+                while True:
+                    item = video_frames.get()
+                    if item is None:
+                        return
+                    i, frame_rgb = item
+                    lm = np.zeros((478, 2))
+                    timestamp_ms = int((1000 / fps) * anti_smooth_factor * i)
+                    store("vid", i, lm, self.detect_frame(vid_landmarker, frame_rgb, lm, timestamp_ms=timestamp_ms))
+            except Exception as e:
+                video_errors.append(e)
+                # keep draining so the decoding thread never blocks on a full queue
+                while video_frames.get() is not None:
+                    pass
+
+        video_thread = None
+        if not single_pass:
+            video_thread = threading.Thread(target=detect_video, name="landmarks-video", daemon=True)
+            video_thread.start()
+        count = 0
+        in_flight = deque()
+        try:
+            pool = self.image_pool(workers)
+            for i, frame_rgb in enumerate(tqdm(frames, total=total)):
+                if i == len(buffers["img"]):
+                    with lock:
+                        for name in buffers:
+                            buffers[name] = grow_buffer(buffers[name], 2 * i)
+                in_flight.append(pool.submit(detect_image, i, frame_rgb))
+                if video_thread is not None:
+                    video_frames.put((i, frame_rgb))
+                while len(in_flight) >= 2 * workers:
+                    in_flight.popleft().result()
+                count = i + 1
+            while in_flight:
+                in_flight.popleft().result()
+        finally:
+            # the pool outlives this call, no detection of it may still write into the buffers
+            for future in in_flight:
+                future.cancel()
+            wait(in_flight)
+            if video_thread is not None:
+                video_frames.put(None)
+                video_thread.join()
+        if video_errors:
+            raise video_errors[0]
+
+        results = {name: buffer[:count] for name, buffer in buffers.items()}
+        if single_pass:
+            results["vid"], results["vid_ok"] = results["img"], results["img_ok"]
+        valid = results["img_ok"] & results["vid_ok"]
+        for i in np.flatnonzero(~valid):
+            print(f"Warning: failed detect ldm in idx={i}, use previous frame results.")
+            metrics.inc("failed_detections")
+        for name in ("img", "vid"):
+            # forward fill from the last detection, frames before the first one stay at 0
+            last = np.maximum.accumulate(np.where(results[name + "_ok"], np.arange(count), 0))
+            results[name] = results[name][last]
+        return results["img"], results["vid"], valid
+
+    def iter_lm478_keyframes(self, frames, keyframe_interval=5, min_confidence=0.8, track_roi=False, tracker=None):
+        """
+        Run the IMAGE landmarker only every keyframe_interval frames, or as soon as tracking confidence drops
+        below min_confidence, and carry the landmarks through the frames in between with optical flow.
+        A frame that can be neither detected nor tracked is yielded as SOURCE_FAILED with zeros,
+        extract_lm478_from_frames interpolates those from the neighbouring frames.
+        track_roi: detect keyframes on a crop around the tracked face first
+        tracker: FlowTracker, default one when None
+        yield: lm478 [478, 2], landmark_tracking.SOURCE_* flag for each frame
+        """
+        img_landmarker = self.img_landmarker
+        tracker = tracker or FlowTracker()
+        prev_gray = points = None
+        since_detect = 0
+        for i, frame_rgb in enumerate(frames):
+            gray = tracker.prepare(frame_rgb)
+            tracked, confidence = None, 0.0
+            if points is not None:
+                tracked, confidence = tracker.track(prev_gray, gray, points)
+            lm, src = np.zeros((478, 2)), SOURCE_FAILED
+            if tracked is None or since_detect >= keyframe_interval or confidence < min_confidence:
+                found = tracked is not None and track_roi and \
+                    self.detect_frame(img_landmarker, frame_rgb, lm, roi_from_landmarks(tracked, self.roi_margin))
+                if found or self.detect_frame(img_landmarker, frame_rgb, lm):
+                    src = SOURCE_DETECTED
+                    since_detect = 0
+            if src == SOURCE_FAILED and confidence >= min_confidence:
+                # missed keyframe detection, keep following the face
+                lm, src = tracked, SOURCE_TRACKED
+            if src == SOURCE_FAILED:
+                print(f"Warning: failed detect ldm in idx={i}, interpolated from the neighbouring frames.")
+                metrics.inc("failed_detections")
+            points = None if src == SOURCE_FAILED else lm
+            prev_gray = gray
+            since_detect += 1
+            yield lm, src
+
+    def iter_lm478_from_frames(self, frames, fps=25, anti_smooth_factor=20, track_roi=False, start_index=0,
+                               single_pass=False):
+        """
+        Streaming form of extract_lm478_from_frames, every frame is detected as soon as it is consumed.
+        start_index: index of the first frame in the whole video, keeps VIDEO mode timestamps absolute
+                     when only a segment is streamed
+        single_pass: only run the IMAGE landmarker, vid_lm478 is the same unsmoothed result
+        yield: img_lm478 [478, 2], vid_lm478 [478, 2], valid for each frame
+        """
+        img_landmarker = self.img_landmarker
+        vid_landmarker = None if single_pass else self.new_video_stream()
+        img_prev = vid_prev = None
+        tracking = False
+        for i, frame_rgb in enumerate(frames):
+            img_lm = np.zeros((478, 2))
+            vid_lm = np.zeros((478, 2))
+            timestamp_ms = int((1000 / fps) * anti_smooth_factor * (start_index + i))
+            if track_roi:
+                img_ok = tracking and self.detect_frame(img_landmarker, frame_rgb, img_lm,
+                                                        roi_from_landmarks(img_prev, self.roi_margin))
+                if not img_ok:
+                    # tracking lost, fall back to full-frame detection
+                    img_ok = self.detect_frame(img_landmarker, frame_rgb, img_lm)
+                tracking = img_ok
+            else:
+                img_ok = self.detect_frame(img_landmarker, frame_rgb, img_lm)
+            if single_pass:
+                vid_lm, vid_ok = img_lm, img_ok
+            elif track_roi:
+                # the video landmarker always sees the same crop size, centered on this frame's face
+                vid_ok = img_ok and self.detect_frame(vid_landmarker, frame_rgb, vid_lm,
+                                                      roi_from_landmarks(img_lm, self.roi_margin), timestamp_ms)
+            else:
+                vid_ok = self.detect_frame(vid_landmarker, frame_rgb, vid_lm, timestamp_ms=timestamp_ms)
+            if not (img_ok and vid_ok):
+                print(f"Warning: failed detect ldm in idx={start_index + i}, use previous frame results.")
+                metrics.inc("failed_detections")
+                if not img_ok and img_prev is not None:
+                    img_lm = img_prev
+                if not vid_ok and vid_prev is not None:
+                    vid_lm = vid_prev
+            img_prev, vid_prev = img_lm, vid_lm
+            yield img_lm, vid_lm, img_ok and vid_ok
 
     def combine_vid_img_lm478_to_lm68(self, img_lm478, vid_lm478):
-        img_lm68 = img_lm478[:, index_lm68_from_lm478]
-        vid_lm68 = vid_lm478[:, index_lm68_from_lm478]
-        combined_lm68 = copy.deepcopy(img_lm68)
-        combined_lm68[:, index_yaw_from_lm68] = vid_lm68[:, index_yaw_from_lm68]
-        combined_lm68[:, index_brow_from_lm68] = vid_lm68[:, index_brow_from_lm68]
-        combined_lm68[:, index_nose_from_lm68] = vid_lm68[:, index_nose_from_lm68]
-        return combined_lm68
+        return combine_lm478_to_lm68(img_lm478, vid_lm478)
 
     def combine_vid_img_lm478_to_lm478(self, img_lm478, vid_lm478):
-        combined_lm478 = copy.deepcopy(vid_lm478)
-        combined_lm478[:, index_mouth_from_lm478] = img_lm478[:, index_mouth_from_lm478]
-        combined_lm478[:, index_eye_from_lm478] = img_lm478[:, index_eye_from_lm478]
-        return combined_lm478
+        return combine_lm478(img_lm478, vid_lm478)
@@ -3,6 +3,11 @@ import cv2
 import imageio.v2 as iio
 import json
 
+from utils.frame_source import VideoFrameSource
+from utils.landmark_layouts import SWAP_POINTS
+from utils.mesh_warp import MeshWarper
+from utils.metrics import metrics
+
 
 def read_points(path):
     # Create an array of points.
@@ -45,33 +50,16 @@ def read_json_data(file_path):
 
 
 def read_video_to_frames(video_name):
-    frames = []
-    cap = cv2.VideoCapture(video_name)
-    if not cap.isOpened():
-        raise IOError(f"Cannot open video file {video_name}")
-    count = 0
-    while True:
-        ret, frame_bgr = cap.read()
-        if not ret:
-            print("Reached the end of the video or failed to read the frame.")
-            break  # If no frame can be read, exit the loop
-        if frame_bgr is None:
-            break
-        frames.append(frame_bgr)
-        count += 1
-    cap.release()
+    frames = VideoFrameSource(video_name).read_all()
     print(f'read {len(frames)} frames')
-    frames = np.stack(frames)
-    frames = np.flip(frames, -1)  # BGR to RGB
     return frames
 
 
 def remove_specific_elements(input_list):
+    # drop the jaw ends, brows and eyes: [68, 2] -> [44, 2]
     if len(input_list) != 68:
         raise ValueError("Input list must have exactly 68 elements")
-
-    indices_to_remove = [0, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47]
-    return [item for index, item in enumerate(input_list) if index not in indices_to_remove]
+    return SWAP_POINTS.apply(input_list)
 
 
 def apply_affine_transform(src, src_tri, dst_tri, size):
@@ -98,40 +86,74 @@ def rect_contains(rect, point):
 
 
 def calculate_delaunay_triangles(rect, points):
+    points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+
     # Create subdiv
     subdiv = cv2.Subdiv2D(rect)
 
     # Insert points into subdiv
     for p in points:
-        subdiv.insert(p)
-
-    triangle_list = subdiv.getTriangleList()
-
-    delaunay_tri = []
-
-    point = []
-
-    for t in triangle_list:
-        point.append((t[0], t[1]))
-        point.append((t[2], t[3]))
-        point.append((t[4], t[5]))
-
-        point1 = (t[0], t[1])
-        point2 = (t[2], t[3])
-        point3 = (t[4], t[5])
-
-        if rect_contains(rect, point1) and rect_contains(rect, point2) and rect_contains(rect, point3):
-            index = []
-            # Get face points (from 68 face detector) by coordinates
-            for j in range(0, 3):
-                for k in range(0, len(points)):
-                    if (abs(point[j][0] - points[k][0]) < 1.0 and abs(point[j][1] - points[k][1]) < 1.0):
-                        index.append(k)
-            if len(index) == 3:
-                delaunay_tri.append((index[0], index[1], index[2]))
-
-        point = []
-    return delaunay_tri
+        subdiv.insert((float(p[0]), float(p[1])))
+
+    triangle_list = subdiv.getTriangleList().reshape(-1, 3, 2)
+
+    # Keep triangles whose vertices all lie inside rect
+    inside = ((triangle_list[..., 0] >= rect[0]) & (triangle_list[..., 1] >= rect[1])
+              & (triangle_list[..., 0] <= rect[0] + rect[2]) & (triangle_list[..., 1] <= rect[1] + rect[3])).all(axis=1)
+
+    # Get face points by coordinates, every vertex must match exactly one point: [M, 3, N]
+    match = (np.abs(triangle_list[:, :, None, :] - points[None, None, :, :]) < 1.0).all(axis=-1)
+    valid = inside & (match.sum(axis=-1) == 1).all(axis=1)
+    index = match.argmax(axis=-1)[valid]
+
+    return [tuple(t) for t in index.tolist()]
+
+
+def triangle_signed_areas(triangles):
+    # triangles: [M, 3, 2]
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    return 0.5 * ((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0]))
+
+
+class DelaunayCache:
+    """
+    Per-track cache of the Delaunay triangulation over the convex hull points.
+    The triangles are reused across frames while the hull membership stays the same and no triangle
+    becomes degenerate or flips, otherwise they are recomputed.
+    """
+
+    def __init__(self, min_area=1.0):
+        self.min_area = min_area
+        self.key = None
+        self.triangles = None  # [M, 3], indices into the landmark array
+        self.orientation = None
+        self.hits = 0
+        self.recomputes = 0
+
+    def get(self, rect, points, hull_index):
+        """
+        points: [N, 2] landmarks
+        hull_index: indices of the convex hull points in points
+        return: [M, 3] triangles as indices into points
+        """
+        points = np.asarray(points, dtype=np.float32)
+        hull_index = np.asarray(hull_index).reshape(-1)
+        key = (tuple(rect), frozenset(hull_index.tolist()))
+        if key == self.key:
+            area = triangle_signed_areas(points[self.triangles])
+            if np.all(np.abs(area) >= self.min_area) and np.all(np.sign(area) == self.orientation):
+                self.hits += 1
+                return self.triangles
+
+        with metrics.timer("triangulate"):
+            dt = calculate_delaunay_triangles(rect, points[hull_index])
+        self.triangles = hull_index[np.array(dt, dtype=np.int64).reshape(-1, 3)]
+        self.orientation = np.sign(triangle_signed_areas(points[self.triangles]))
+        # never keep an empty triangulation around
+        self.key = key if len(self.triangles) else None
+        self.recomputes += 1
+        metrics.inc("triangulation_recomputes")
+        return self.triangles
 
 
 def warp_triangle(img1, img2, t1, t2):
@@ -186,59 +208,286 @@ def resize_with_aspect_ratio(image, width=None, height=None, inter=cv2.INTER_ARE
     return cv2.resize(image, dim, interpolation=inter)
 
 
-def face_swap(img1, img2, points1, points2):
-    img1_warped = np.copy(img2)
-
+BLEND_MODES = ("normal", "mixed", "feather", "laplacian")
+
+
+def feather_blend(src, dst, mask, radius=None):
+    """
+    Alpha blend src over dst with the mask edge feathered by a gaussian of the given radius.
+    mask: single channel uint8, 255 inside the face
+    """
+    if radius is None:
+        radius = max(3, int(0.04 * max(mask.shape)))
+    alpha = cv2.GaussianBlur(mask, (2 * radius + 1, 2 * radius + 1), 0)
+    alpha = alpha.astype(np.float32)[..., None] * (1.0 / 255)
+    blended = dst.astype(np.float32)
+    blended += (src.astype(np.float32) - blended) * alpha
+    return np.clip(blended + 0.5, 0, 255).astype(np.uint8)
+
+
+def laplacian_blend(src, dst, mask, levels=None):
+    """
+    Multi-band blend: laplacian pyramids of src and dst mixed by a gaussian pyramid of the mask.
+    mask: single channel uint8, 255 inside the face
+    """
+    if levels is None:
+        levels = max(1, min(5, int(np.log2(max(min(mask.shape), 2))) - 3))
+    alpha = mask.astype(np.float32) * (1.0 / 255)
+    gs, gd, ga = [src.astype(np.float32)], [dst.astype(np.float32)], [alpha]
+    for _ in range(levels):
+        gs.append(cv2.pyrDown(gs[-1]))
+        gd.append(cv2.pyrDown(gd[-1]))
+        ga.append(cv2.pyrDown(ga[-1]))
+    a = ga[-1][..., None]
+    blended = gs[-1] * a + gd[-1] * (1 - a)
+    for i in range(levels - 1, -1, -1):
+        size = (gs[i].shape[1], gs[i].shape[0])
+        ls = gs[i] - cv2.pyrUp(gs[i + 1], dstsize=size)
+        ld = gd[i] - cv2.pyrUp(gd[i + 1], dstsize=size)
+        a = ga[i][..., None]
+        blended = cv2.pyrUp(blended, dstsize=size) + ls * a + ld * (1 - a)
+    return np.clip(blended + 0.5, 0, 255).astype(np.uint8)
+
+
+def blend_face(warped, target, mask, center, blend_mode="normal"):
+    """
+    warped, target: face ROI of the warped source and of the target frame
+    mask: single channel uint8 ROI mask, center: face center in ROI coordinates
+    blend_mode: normal / mixed (seamlessClone NORMAL_CLONE / MIXED_CLONE), feather or laplacian,
+                the last two skip the poisson solve for throughput
+    """
+    if blend_mode == "normal":
+        return cv2.seamlessClone(warped, target, mask, center, cv2.NORMAL_CLONE)
+    if blend_mode == "mixed":
+        return cv2.seamlessClone(warped, target, mask, center, cv2.MIXED_CLONE)
+    if blend_mode == "feather":
+        return feather_blend(warped, target, mask)
+    if blend_mode == "laplacian":
+        return laplacian_blend(warped, target, mask)
+    raise ValueError(f"blend_mode must be one of {BLEND_MODES}, got {blend_mode}")
+
+
+def face_roi(rect, shape):
+    # face bounding rect plus a margin, clipped to the image: (x0, y0, x1, y1)
+    margin = max(16, int(0.15 * max(rect[2], rect[3])))
+    x0, y0 = max(rect[0] - margin, 0), max(rect[1] - margin, 0)
+    x1, y1 = min(rect[0] + rect[2] + margin, shape[1]), min(rect[1] + rect[3] + margin, shape[0])
+    return x0, y0, x1, y1
+
+
+def face_color_stats(image, mask):
+    # per-channel mean and std of image inside mask: ([C], [C]) float32
+    mean, std = cv2.meanStdDev(image, mask=mask)
+    return mean.reshape(-1).astype(np.float32), np.maximum(std.reshape(-1), 1.0).astype(np.float32)
+
+
+def match_color(image, mask, source_stats, target_stats):
+    """
+    Move the colour statistics of image from source_stats to target_stats, one 256 entry lookup table per channel.
+    Only the pixels inside mask are changed.
+    """
+    (src_mean, src_std), (dst_mean, dst_std) = source_stats, target_stats
+    levels = np.arange(256, dtype=np.float32)[:, None]
+    lut = np.clip((levels - src_mean) * (dst_std / src_std) + dst_mean + 0.5, 0, 255).astype(np.uint8)
+    matched = cv2.LUT(image, lut.reshape(256, 1, -1))
+    np.copyto(image, matched, where=(mask > 0)[..., None])
+    return image
+
+
+def face_swap(img1, img2, points1, points2, tri_cache=None, warper=None, blend_mode="normal", dirty_box=None):
+    """
+    dirty_box: (x0, y0, x1, y1) part of img1 that changed although the mesh did not, for an incremental MeshWarper
+    """
     # Points
-    points1 = remove_specific_elements(points1)
-    points2 = remove_specific_elements(points2)
+    points1 = np.asarray(remove_specific_elements(points1), dtype=np.float32)
+    return _face_swap(img1, img2, points1, points2, tri_cache, warper, blend_mode, dirty_box)
 
-    # Find convex hull
-    hull1 = []
-    hull2 = []
 
-    hull_index = cv2.convexHull(np.array(points2), returnPoints=False)
+def _face_swap(img1, img2, points1, points2, tri_cache=None, warper=None, blend_mode="normal", dirty_box=None,
+               color_stats=None):
+    """
+    face_swap with the source points already filtered to the swap points, points2 are 68 point landmarks.
+    color_stats: source face colour statistics, the warped face is matched to the target face colours
+    """
+    points2 = np.asarray(remove_specific_elements(points2), dtype=np.float32)
 
-    for i in range(0, len(hull_index)):
-        hull1.append(points1[int(hull_index[i])])
-        hull2.append(points2[int(hull_index[i])])
+    # Find convex hull
+    hull_index = cv2.convexHull(points2, returnPoints=False).reshape(-1)
+    hull2 = points2[hull_index]
 
     # Find Delaunay triangulation for convex hull points
     size_img2 = img2.shape
     rect = (0, 0, size_img2[1], size_img2[0])
 
-    dt = calculate_delaunay_triangles(rect, hull2)
+    if tri_cache is None:
+        tri_cache = DelaunayCache()
+    dt = tri_cache.get(rect, points2, hull_index)
 
     if len(dt) == 0:
-        quit()
-
-    # Apply affine transformation to Delaunay triangles
-    for i in range(0, len(dt)):
-        t1 = []
-        t2 = []
-
-        # Get points for img1, img2 corresponding to the triangles
-
-        for j in range(0, 3):
-            t1.append(hull1[dt[i][j]])
-            t2.append(hull2[dt[i][j]])
-
-        warp_triangle(img1, img1_warped, t1, t2)
+        # nothing to warp, keep the target frame rather than exiting the process (and any pool worker)
+        print("Warning: no Delaunay triangles for this frame, target frame returned unchanged.")
+        metrics.inc("dropped_frames")
+        return np.copy(img2)
+
+    # Work on the face bounding box plus a margin only
+    r = cv2.boundingRect(hull2)
+    x0, y0, x1, y1 = face_roi(r, size_img2)
+    offset = np.float32([x0, y0])
+    target_roi = img2[y0:y1, x0:x1]
+
+    # Apply affine transformation to all Delaunay triangles in one remap
+    if warper is None:
+        warper = MeshWarper()
+    img1_warped = np.copy(target_roi)
+    with metrics.timer("warp"):
+        warper.warp(img1, img1_warped, points1[dt], points2[dt] - offset, dirty_box)
 
     # Calculate Mask
-    hull8U = []
-    for i in range(0, len(hull2)):
-        hull8U.append((hull2[i][0], hull2[i][1]))
-
-    mask = np.zeros(img2.shape, dtype=img2.dtype)
+    mask = np.zeros(target_roi.shape[:2], dtype=np.uint8)
 
-    cv2.fillConvexPoly(mask, np.int32(hull8U), (255, 255, 255))
+    cv2.fillConvexPoly(mask, np.int32(hull2 - offset), 255)
 
-    r = cv2.boundingRect(np.float32([hull2]))
+    if color_stats is not None:
+        match_color(img1_warped, mask, color_stats, face_color_stats(target_roi, mask))
 
-    center = ((r[0] + int(r[2] / 2), r[1] + int(r[3] / 2)))
+    center = ((r[0] - x0 + int(r[2] / 2), r[1] - y0 + int(r[3] / 2)))
 
-    # Clone seamlessly.
-    output = cv2.seamlessClone(np.uint8(img1_warped), img2, mask, center, cv2.NORMAL_CLONE)
+    # Blend inside the ROI and paste it back
+    output = np.copy(img2)
+    with metrics.timer("blend"):
+        output[y0:y1, x0:x1] = blend_face(img1_warped, target_roi, mask, center, blend_mode)
 
     return output
+
+
+class SourceFace:
+    """
+    Source side of an image-to-video swap, prepared once from a still image and its 68 point landmarks:
+    the filtered swap points, a contiguous crop of the face with the points moved into it, and the
+    colour statistics of the face. Swapping it onto a stream of target frames then only does target side work.
+    color_match: match the warped face to the colours of each target face, mostly useful for the
+                 feather and laplacian blend modes that keep the source colours
+    """
+
+    def __init__(self, image, landmarks, color_match=False):
+        points = np.asarray(remove_specific_elements(landmarks), dtype=np.float32)
+        hull = cv2.convexHull(points)
+        self.rect = cv2.boundingRect(hull)
+        x0, y0, x1, y1 = face_roi(self.rect, image.shape)
+        # remap only ever reads around the face, a small crop stays in cache
+        self.image = np.ascontiguousarray(image[y0:y1, x0:x1])
+        self.offset = np.float32([x0, y0])
+        self.points = points - self.offset
+        mask = np.zeros(self.image.shape[:2], dtype=np.uint8)
+        cv2.fillConvexPoly(mask, np.int32(hull.reshape(-1, 2) - self.offset), 255)
+        self.color_stats = face_color_stats(self.image, mask)
+        self.color_match = color_match
+
+    @classmethod
+    def from_image_name(cls, img_name, landmarks=None, color_match=False):
+        """
+        landmarks: 68 point landmarks of the image, detected with MediapipeLandmarker when None
+        """
+        img = cv2.cvtColor(cv2.imread(img_name), cv2.COLOR_BGR2RGB)
+        if landmarks is None:
+            from utils.face_landmarker import MediapipeLandmarker, index_lm68_from_lm478
+            with MediapipeLandmarker() as landmarker:
+                landmarks = landmarker.extract_lm478_from_img(img)[index_lm68_from_lm478]
+        return cls(img, landmarks, color_match)
+
+    def swap(self, img2, points2, tri_cache=None, warper=None, blend_mode="normal"):
+        return _face_swap(self.image, img2, self.points, points2, tri_cache, warper, blend_mode,
+                          color_stats=self.color_stats if self.color_match else None)
+
+
+class FaceSwapper:
+    """
+    face_swap over consecutive frames of one source / target pair, keeping the triangulation and remap caches.
+    motion_threshold: None swaps every frame in full. Otherwise a landmark that moved no more than this many
+                      pixels since it was last used keeps its previous position, so near-static frames keep
+                      the same mesh: the warped face patch is reused for every triangle whose vertices all
+                      stayed and only the triangles around moved landmarks are warped again.
+                      The blend still runs on every frame, the target around the face changes.
+    """
+
+    def __init__(self, blend_mode="normal", motion_threshold=None):
+        self.blend_mode = blend_mode
+        self.motion_threshold = motion_threshold
+        self.tri_cache = DelaunayCache()
+        self.warper = MeshWarper(incremental=motion_threshold is not None)
+        self.anchors = [None, None]
+        self.frames = 0
+        self.static_frames = 0
+
+    def _anchor(self, side, points):
+        """
+        return: anchored points, previous and new positions of the landmarks that moved
+        """
+        points = np.asarray(points, dtype=np.float32)
+        anchor = self.anchors[side]
+        if anchor is None or anchor.shape != points.shape:
+            self.anchors[side] = points.copy()
+            return self.anchors[side], points
+        moved = np.hypot(*(points - anchor).T) > self.motion_threshold
+        moved_points = np.concatenate([anchor[moved], points[moved]])
+        anchor[moved] = points[moved]
+        return anchor, moved_points
+
+    def swap(self, img1, img2, points1, points2):
+        self.frames += 1
+        if self.motion_threshold is None:
+            return face_swap(img1, img2, points1, points2, self.tri_cache, self.warper, self.blend_mode)
+        points1, moved1 = self._anchor(0, points1)
+        points2, moved2 = self._anchor(1, points2)
+        if not (len(moved1) or len(moved2)):
+            self.static_frames += 1
+        # inner source landmarks (lips, eyes) are not mesh vertices, the triangles around them are re-sampled
+        dirty_box = None
+        if len(moved1):
+            lo = moved1.min(axis=0) - self.motion_threshold
+            hi = moved1.max(axis=0) + self.motion_threshold
+            dirty_box = (lo[0], lo[1], hi[0], hi[1])
+        return face_swap(img1, img2, points1, points2, self.tri_cache, self.warper, self.blend_mode, dirty_box)
+
+    def swap_source(self, source, img2, points2):
+        """
+        Swap a SourceFace onto img2. The source never changes, only the target landmarks are anchored.
+        """
+        self.frames += 1
+        if self.motion_threshold is not None:
+            points2, moved2 = self._anchor(1, points2)
+            if not len(moved2):
+                self.static_frames += 1
+        return source.swap(img2, points2, self.tri_cache, self.warper, self.blend_mode)
+
+    def stats(self):
+        triangles = self.warper.triangles_warped + self.warper.triangles_reused
+        return {
+            "frames": self.frames,
+            "static_frames": self.static_frames,
+            "triangles_warped": self.warper.triangles_warped,
+            "triangles_reused": self.warper.triangles_reused,
+            "reuse_rate": round(self.warper.triangles_reused / triangles, 3) if triangles else 0.0,
+            "triangulation_recomputes": self.tri_cache.recomputes,
+        }
+
+
+def face_swap_frames(frames1, frames2, landmarks1, landmarks2, blend_mode="normal", motion_threshold=None):
+    """
+    frames1, frames2: iterables of RGB frames, e.g. VideoFrameSource, consumed one frame at a time
+    motion_threshold: reuse the warped face on near-static frames, see FaceSwapper
+    stops at the shortest of the four inputs
+    """
+    swapper = FaceSwapper(blend_mode, motion_threshold)
+    for img1, img2, points1, points2 in zip(frames1, frames2, landmarks1, landmarks2):
+        yield swapper.swap(img1, img2, points1, points2)
+
+
+def face_swap_image_frames(source, frames2, landmarks2, blend_mode="normal", motion_threshold=None):
+    """
+    Image-to-video swap: source is a SourceFace, prepared once, frames2 and landmarks2 the target stream.
+    motion_threshold: reuse the warped face on near-static frames, see FaceSwapper
+    """
+    swapper = FaceSwapper(blend_mode, motion_threshold)
+    for img2, points2 in zip(frames2, landmarks2):
+        yield swapper.swap_source(source, img2, points2)
@@ -0,0 +1,101 @@
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from utils.metrics import metrics
+
+
+class VideoFrameSource:
+    """
+    Streams the frames of a video as C-contiguous RGB uint8 arrays.
+    Decoding runs on a background thread into a bounded prefetch buffer, so memory stays
+    constant whatever the video length. frame_count comes from the container and may be an estimate.
+    start, stop: only stream frames [start, stop) of the video, e.g. one segment of a long video
+    """
+
+    def __init__(self, video_name, prefetch=8, start=0, stop=None):
+        cap = cv2.VideoCapture(video_name)
+        if not cap.isOpened():
+            raise IOError(f"Cannot open video file {video_name}")
+        self.video_name = video_name
+        self.prefetch = max(1, int(prefetch))
+        self.fps = cap.get(cv2.CAP_PROP_FPS)
+        self.frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        cap.release()
+        self.start = max(0, int(start))
+        self.stop = stop
+
+    @property
+    def shape(self):
+        return len(self), self.height, self.width, 3
+
+    def __len__(self):
+        stop = self.frame_count if self.stop is None else min(self.stop, self.frame_count)
+        return max(stop - self.start, 0)
+
+    def __iter__(self):
+        buffer = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        decoder = threading.Thread(target=self._decode, args=(buffer, stop), daemon=True)
+        decoder.start()
+        try:
+            while True:
+                frame = buffer.get()
+                if frame is None:
+                    break
+                if isinstance(frame, BaseException):
+                    raise frame
+                yield frame
+        finally:
+            stop.set()
+            # keep draining so the decoder is never left blocked on a full buffer
+            while decoder.is_alive():
+                try:
+                    buffer.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            decoder.join()
+
+    def _decode(self, buffer, stop):
+        cap = cv2.VideoCapture(self.video_name)
+        remaining = None if self.stop is None else self.stop - self.start
+        try:
+            if self.start:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, self.start)
+            while not stop.is_set() and remaining != 0:
+                with metrics.timer("decode"):
+                    ret, frame = cap.read()
+                    if not ret or frame is None:
+                        break
+                    # BGR to RGB in place, the decoded buffer is already C-contiguous
+                    cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+                buffer.put(frame)
+                if remaining is not None:
+                    remaining -= 1
+        except Exception as e:
+            buffer.put(e)
+        finally:
+            cap.release()
+            buffer.put(None)
+
+    def read_all(self):
+        """
+        Decode the whole video into one [T, H, W, 3] RGB array, filling a preallocated buffer
+        instead of stacking a list of frames.
+        """
+        frames = np.empty(self.shape, dtype=np.uint8)
+        extra = []
+        count = 0
+        for frame in self:
+            if count < len(frames):
+                frames[count] = frame
+            else:
+                extra.append(frame)
+            count += 1
+        if extra:
+            frames = np.concatenate([frames, np.stack(extra)])
+        return frames[:count]
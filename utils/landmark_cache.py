@@ -0,0 +1,115 @@
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from utils.landmark_io import LandmarkTrack, LANDMARK_TRACK_EXT
+
+
+class LandmarkCache:
+    """
+    Content-addressed cache of extracted landmark tracks.
+    Entries are keyed by a hash of the video bytes plus the extraction parameters, stored as binary
+    landmark tracks in cache_dir and evicted least recently used first once they exceed max_bytes.
+    """
+
+    def __init__(self, cache_dir="landmark_cache", max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._file_hashes = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def hash_file(self, path, chunk_size=1 << 20):
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._file_hashes:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    h.update(chunk)
+            self._file_hashes[memo_key] = h.hexdigest()
+        return self._file_hashes[memo_key]
+
+    def key(self, video_name, **params):
+        h = hashlib.sha256(self.hash_file(video_name).encode("ascii"))
+        h.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    def _path(self, key, name):
+        return os.path.join(self.cache_dir, f"{key}.{name}{LANDMARK_TRACK_EXT}")
+
+    def _entries(self):
+        # key -> (last access, total bytes, files)
+        # other processes may share cache_dir, a file evicted by one of them since the glob is skipped
+        entries = {}
+        for path in glob.glob(os.path.join(self.cache_dir, f"*{LANDMARK_TRACK_EXT}")):
+            key = os.path.basename(path).split(".", 1)[0]
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            atime, size, files = entries.get(key, (0.0, 0, []))
+            entries[key] = (max(atime, stat.st_mtime), size + stat.st_size, files + [path])
+        return entries
+
+    def get(self, key, names):
+        """
+        return: {name: LandmarkTrack} when every named track of the entry is cached, else None
+        """
+        paths = {name: self._path(key, name) for name in names}
+        try:
+            for path in paths.values():
+                # mtime doubles as last access time for the LRU order
+                os.utime(path)
+            tracks = {name: LandmarkTrack.open(path) for name, path in paths.items()}
+        except FileNotFoundError:
+            # not cached, or evicted by another process sharing cache_dir
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tracks
+
+    def put(self, key, tracks):
+        """
+        tracks: {name: LandmarkTrack}
+        """
+        for name, track in tracks.items():
+            path = self._path(key, name)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            track.save(tmp_path)
+            os.replace(tmp_path, path)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries.values())
+        for key, (_, size, files) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for path in files:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # already evicted by another process
+                    pass
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": int(np.sum([size for _, size, _ in entries.values()])),
+        }
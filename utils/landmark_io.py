@@ -0,0 +1,149 @@
+import json
+import struct
+
+import numpy as np
+
+# binary landmark track: magic, uint32 header length, json header, then 64-byte aligned data:
+# points float32 [T, N, 2] followed by the per-frame detection valid mask uint8 [T]
+LANDMARK_TRACK_EXT = ".lmk"
+LANDMARK_TRACK_MAGIC = b"LMKTRACK"
+LANDMARK_TRACK_VERSION = 1
+_ALIGN = 64
+
+# landmark scheme by number of points
+SCHEME_BY_NUM_POINTS = {478: "lm478", 131: "lm131", 141: "lm141", 68: "lm68", 17: "half_face", 16: "homolm"}
+# schemes sharing a point count with the one above, only binary tracks keep them apart through their header,
+# json files have to pass scheme= to load_landmark_track
+SCHEME_ALIASES = {"half_face_mask": 17}
+
+
+def _align(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def guess_landmark_scheme(num_points):
+    return SCHEME_BY_NUM_POINTS.get(num_points, f"lm{num_points}")
+
+
+def check_landmark_scheme(scheme, num_points):
+    expected = SCHEME_ALIASES.get(scheme, {v: k for k, v in SCHEME_BY_NUM_POINTS.items()}.get(scheme))
+    if expected is not None and expected != num_points:
+        raise ValueError(f"landmark scheme {scheme} has {expected} points, got {num_points}")
+    return scheme
+
+
+class LandmarkTrack:
+    """
+    Landmark track of a video: points [T, N, 2] plus scheme, fps, frame size (W, H) and a per-frame
+    detection valid mask. Tracks opened from disk are memory-mapped, so indexing a frame is O(1).
+    """
+
+    def __init__(self, points, scheme=None, fps=25.0, frame_size=None, valid=None):
+        points = np.asarray(points)
+        if points.ndim != 3 or points.shape[-1] != 2:
+            raise ValueError(f"landmark track must be [T, N, 2], got {points.shape}")
+        self.points = points
+        self.scheme = check_landmark_scheme(scheme or guess_landmark_scheme(points.shape[1]), points.shape[1])
+        self.fps = float(fps)
+        self.frame_size = tuple(frame_size) if frame_size is not None else None
+        self.valid = np.ones(len(points), dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+
+    @property
+    def num_points(self):
+        return self.points.shape[1]
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, index):
+        return self.points[index]
+
+    def __iter__(self):
+        return iter(self.points)
+
+    def tolist(self, rounding=True):
+        # json compatible nested lists, rounded to int pixels like the json landmark files
+        points = np.rint(self.points).astype(int) if rounding else self.points
+        return points.tolist()
+
+    def save(self, path):
+        points = np.ascontiguousarray(self.points, dtype="<f4")
+        header = {
+            "version": LANDMARK_TRACK_VERSION,
+            "scheme": self.scheme,
+            "fps": self.fps,
+            "frame_size": list(self.frame_size) if self.frame_size is not None else None,
+            "num_frames": len(points),
+            "num_points": points.shape[1],
+            "dtype": "<f4",
+        }
+        header_bytes = json.dumps(header).encode("utf-8")
+        points_offset = _align(len(LANDMARK_TRACK_MAGIC) + 4 + len(header_bytes))
+        with open(path, "wb") as f:
+            f.write(LANDMARK_TRACK_MAGIC)
+            f.write(struct.pack("<I", len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b"\0" * (points_offset - f.tell()))
+            f.write(points.tobytes())
+            f.write(self.valid.astype(np.uint8).tobytes())
+
+    @classmethod
+    def open(cls, path):
+        with open(path, "rb") as f:
+            magic = f.read(len(LANDMARK_TRACK_MAGIC))
+            if magic != LANDMARK_TRACK_MAGIC:
+                raise ValueError(f"'{path}' is not a landmark track file")
+            header_len, = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(header_len).decode("utf-8"))
+        if header["version"] > LANDMARK_TRACK_VERSION:
+            raise ValueError(f"unsupported landmark track version {header['version']}")
+        num_frames, num_points = header["num_frames"], header["num_points"]
+        points_offset = _align(len(LANDMARK_TRACK_MAGIC) + 4 + header_len)
+        valid_offset = points_offset + num_frames * num_points * 2 * 4
+        if num_frames == 0:
+            points = np.zeros((0, num_points, 2), dtype=header["dtype"])
+            valid = np.zeros(0, dtype=bool)
+        else:
+            points = np.memmap(path, dtype=header["dtype"], mode="r", offset=points_offset,
+                               shape=(num_frames, num_points, 2))
+            valid = np.memmap(path, dtype=np.uint8, mode="r", offset=valid_offset, shape=(num_frames,))
+        return cls(points, header["scheme"], header["fps"], header["frame_size"], valid.view(bool))
+
+
+def save_landmark_track(path, points, scheme=None, fps=25.0, frame_size=None, valid=None):
+    track = LandmarkTrack(points, scheme, fps, frame_size, valid)
+    track.save(path)
+    return track
+
+
+def convert_json_to_track(json_path, track_path=None, scheme=None, fps=25.0, frame_size=None):
+    with open(json_path, "r") as f:
+        data = json.load(f)
+    track = LandmarkTrack(np.asarray(data, dtype=np.float32).reshape(len(data), -1, 2), scheme, fps, frame_size)
+    if track_path is not None:
+        track.save(track_path)
+    return track
+
+
+def load_landmark_track(path, scheme=None, fps=25.0, frame_size=None):
+    """
+    Open a binary landmark track, or convert a legacy json landmark file on the fly.
+    scheme, fps and frame_size only apply to json files, which do not store them.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(LANDMARK_TRACK_MAGIC))
+    if magic == LANDMARK_TRACK_MAGIC:
+        return LandmarkTrack.open(path)
+    return convert_json_to_track(path, scheme=scheme, fps=fps, frame_size=frame_size)
+
+
+def write_landmarks(save_path, landmarks, scheme=None, fps=25.0, frame_size=None, valid=None):
+    """
+    landmarks: [T, N, 2], written as a binary track if save_path ends with LANDMARK_TRACK_EXT,
+    otherwise as the json list of int point lists
+    """
+    if save_path.endswith(LANDMARK_TRACK_EXT):
+        save_landmark_track(save_path, np.asarray(landmarks, dtype=np.float32), scheme, fps, frame_size, valid)
+    else:
+        with open(save_path, 'w') as file_object:
+            json.dump(np.rint(np.asarray(landmarks)).astype(int).tolist(), file_object)
@@ -0,0 +1,164 @@
+import numpy as np
+
+# simplified mediapipe ldm at https://github.com/k-m-irfan/simplified_mediapipe_face_landmarks
+index_lm141_from_lm478 = ([70, 63, 105, 66, 107, 55, 65, 52, 53, 46]
+                          + [300, 293, 334, 296, 336, 285, 295, 282, 283, 276]
+                          + [33, 246, 161, 160, 159, 158, 157, 173, 133, 155, 154, 153, 145, 144, 163, 7]
+                          + [263, 466, 388, 387, 386, 385, 384, 398, 362, 382, 381, 380, 374, 373, 390, 249]
+                          + [78, 191, 80, 81, 82, 13, 312, 311, 310, 415, 308, 324, 318, 402, 317, 14, 87, 178, 88, 95]
+                          + [61, 185, 40, 39, 37, 0, 267, 269, 270, 409, 291, 375, 321, 405, 314, 17, 84, 181, 91, 146]
+                          + [10, 338, 297, 332, 284, 251, 389, 356, 454, 323, 361, 288, 397, 365, 379, 378, 400, 377,
+                             152, 148, 176, 149, 150, 136,
+                             172, 58, 132, 93, 234, 127, 162, 21, 54, 103, 67, 109]
+                          + [468, 469, 470, 471, 472]
+                          + [473, 474, 475, 476, 477]
+                          + [64, 4, 294])
+# lm141 without iris
+index_lm131_from_lm478 = ([70, 63, 105, 66, 107, 55, 65, 52, 53, 46]
+                          + [300, 293, 334, 296, 336, 285, 295, 282, 283, 276]
+                          + [33, 246, 161, 160, 159, 158, 157, 173, 133, 155, 154, 153, 145, 144, 163, 7]
+                          + [263, 466, 388, 387, 386, 385, 384, 398, 362, 382, 381, 380, 374, 373, 390, 249]
+                          + [78, 191, 80, 81, 82, 13, 312, 311, 310, 415, 308, 324, 318, 402, 317, 14, 87, 178, 88, 95]
+                          + [61, 185, 40, 39, 37, 0, 267, 269, 270, 409, 291, 375, 321, 405, 314, 17, 84, 181, 91, 146]
+                          + [10, 338, 297, 332, 284, 251, 389, 356, 454, 323, 361, 288, 397, 365, 379, 378, 400, 377,
+                             152, 148, 176, 149, 150, 136,
+                             172, 58, 132, 93, 234, 127, 162, 21, 54, 103, 67, 109]
+                          + [64, 4, 294])
+
+# face alignment lm68
+index_lm68_from_lm478 = [127, 234, 93, 132, 58, 136, 150, 176, 152, 400, 379, 365, 288, 361, 323, 454, 356, 70, 63, 105,
+                         66, 107, 336, 296, 334, 293,
+                         300, 168, 197, 5, 4, 75, 97, 2, 326, 305, 33, 160, 158, 133, 153, 144, 362, 385, 387, 263, 373,
+                         380, 61, 40, 37, 0, 267, 270,
+                         291, 321, 314, 17, 84, 91, 78, 81, 13, 311, 308, 402, 14, 178]
+# used for weights for key parts
+unmatch_mask_from_lm478 = [93, 127, 132, 234, 323, 356, 361, 454]
+index_eye_from_lm478 = ([33, 246, 161, 160, 159, 158, 157, 173, 133, 155, 154, 153, 145, 144, 163, 7]
+                        + [263, 466, 388, 387, 386, 385, 384, 398, 362, 382, 381, 380, 374, 373, 390, 249])
+index_innerlip_from_lm478 = [78, 191, 80, 81, 82, 13, 312, 311, 310, 415, 308, 324, 318, 402, 317, 14, 87, 178, 88, 95]
+index_outerlip_from_lm478 = [61, 185, 40, 39, 37, 0, 267, 269, 270, 409, 291, 375, 321, 405, 314, 17, 84, 181, 91, 146]
+index_withinmouth_from_lm478 = ([76, 62]
+                                + [184, 183, 74, 72, 73, 41, 72, 38, 11, 12, 302, 268, 303, 271, 304, 272, 408, 407]
+                                + [292, 306]
+                                + [325, 307, 319, 320, 403, 404, 316, 315, 15, 16, 86, 85, 179, 180, 89, 90, 96, 77])
+index_mouth_from_lm478 = index_innerlip_from_lm478 + index_outerlip_from_lm478 + index_withinmouth_from_lm478
+
+index_yaw_from_lm68 = list(range(0, 17))
+index_brow_from_lm68 = list(range(17, 27))
+index_nose_from_lm68 = list(range(27, 36))
+index_eye_from_lm68 = list(range(36, 48))
+index_mouth_from_lm68 = list(range(48, 68))
+
+
+class Layout:
+    """
+    A landmark layout as index and offset arrays into a source layout, applied to whole tracks at once.
+    Point k of the output is (src[x_index[k], 0] + offset[k, 0], src[y_index[k], 1] + offset[k, 1]),
+    so derived points may take x and y from different source points.
+    rounding: round to int pixels, like the json landmark files
+    """
+
+    def __init__(self, name, x_index, y_index=None, offset=None, rounding=False):
+        self.name = name
+        self.x_index = np.asarray(x_index, dtype=np.intp)
+        self.y_index = self.x_index if y_index is None else np.asarray(y_index, dtype=np.intp)
+        self.offset = None if offset is None else np.asarray(offset, dtype=np.float64)
+        self.rounding = rounding
+
+    def __len__(self):
+        return len(self.x_index)
+
+    @classmethod
+    def from_points(cls, name, points, rounding=False):
+        """
+        points: [(x source index, y source index, dx, dy)] for each output point
+        """
+        x_index, y_index, dx, dy = zip(*points)
+        return cls(name, x_index, y_index, np.stack([dx, dy], axis=-1), rounding)
+
+    def shifted(self, name, offset, rounding=None):
+        # the same points moved by a further per-point offset
+        offset = np.asarray(offset, dtype=np.float64) + (0 if self.offset is None else self.offset)
+        return Layout(name, self.x_index, self.y_index, offset, self.rounding if rounding is None else rounding)
+
+    def apply(self, landmarks):
+        """
+        landmarks: [..., N, 2], a single frame or a whole track
+        return: [..., len(self), 2] float64, or int64 when rounding
+        """
+        landmarks = np.asarray(landmarks, dtype=np.float64)
+        if self.y_index is self.x_index:
+            out = landmarks[..., self.x_index, :]
+        else:
+            out = np.stack([landmarks[..., self.x_index, 0], landmarks[..., self.y_index, 1]], axis=-1)
+        if self.offset is not None:
+            out += self.offset
+        if self.rounding:
+            return np.rint(out).astype(np.int64)
+        return out
+
+    def to_json(self, landmarks):
+        return self.apply(landmarks).tolist()
+
+
+def half_face_layout(padding=2):
+    """
+    lm68 -> 17 point lower half face: jaw points 2-14 pulled inwards by padding, closed over the nose
+    """
+    points = [(i, i, padding, 0) for i in range(2, 7)]
+    points += [(i, i, 0, 0) for i in range(7, 10)]
+    points += [(i, i, -padding, 0) for i in range(10, 15)]
+    points += [(35, 14, padding, 0), (35, 33, padding, padding), (31, 33, -padding, padding), (31, 2, -padding, 0)]
+    return Layout.from_points("half_face", points)
+
+
+# the contour of half_face_mask: half_face moved in (or out) by a few more pixels per point, in int pixels
+_half_face_mask_offset = ([(5, 0)] * 5 + [(3, -3), (0, -3), (-3, -3)] + [(-5, 0)] * 5
+                          + [(3, 0), (3, 3), (-3, 3), (-3, 0)])
+
+HALF_FACE = half_face_layout()
+HALF_FACE_MASK = HALF_FACE.shifted("half_face_mask", _half_face_mask_offset, rounding=True)
+HOMOLM = Layout.from_points("homolm", [(i, i, 2, 0) for i in range(2, 7)] + [(i, i, 0, 0) for i in range(7, 10)]
+                            + [(i, i, -2, 0) for i in range(10, 15)] + [(35, 35, 0, 0), (29, 29, 0, 0), (31, 31, 0, 0)])
+LM68_FROM_LM478 = Layout("lm68", index_lm68_from_lm478)
+LM131_FROM_LM478 = Layout("lm131", index_lm131_from_lm478)
+LM141_FROM_LM478 = Layout("lm141", index_lm141_from_lm478)
+# lm68 without the jaw ends, brows and eyes, the points face_swap triangulates
+SWAP_POINTS = Layout("swap", np.setdiff1d(np.arange(68), [0, 16] + index_brow_from_lm68 + index_eye_from_lm68))
+
+LAYOUTS = {layout.name: layout for layout in (HALF_FACE, HALF_FACE_MASK, HOMOLM, LM68_FROM_LM478, LM131_FROM_LM478,
+                                              LM141_FROM_LM478, SWAP_POINTS)}
+
+# lm68 points taken from the VIDEO mode (temporally smoothed) detection, the rest comes from IMAGE mode
+_lm68_from_video = np.zeros(68, dtype=bool)
+_lm68_from_video[index_yaw_from_lm68 + index_brow_from_lm68 + index_nose_from_lm68] = True
+_lm478_from_image = np.asarray(index_mouth_from_lm478 + index_eye_from_lm478, dtype=np.intp)
+
+
+def convert(landmarks, layout, as_json=False):
+    """
+    landmarks: [T, N, 2] track or [N, 2] frame, layout: Layout or a name in LAYOUTS
+    return: converted array, or nested lists for json when as_json
+    """
+    if isinstance(layout, str):
+        layout = LAYOUTS[layout]
+    return layout.to_json(landmarks) if as_json else layout.apply(landmarks)
+
+
+def combine_lm478_to_lm68(img_lm478, vid_lm478):
+    """
+    [..., 478, 2] IMAGE and VIDEO mode detections -> [..., 68, 2]: contour, brows and nose from VIDEO mode,
+    eyes and mouth from IMAGE mode
+    """
+    combined = np.asarray(img_lm478)[..., index_lm68_from_lm478, :]
+    combined[..., _lm68_from_video, :] = np.asarray(vid_lm478)[..., LM68_FROM_LM478.x_index[_lm68_from_video], :]
+    return combined
+
+
+def combine_lm478(img_lm478, vid_lm478):
+    """
+    [..., 478, 2] VIDEO mode detection with the mouth and eyes of the IMAGE mode one
+    """
+    combined = np.array(vid_lm478)
+    combined[..., _lm478_from_image, :] = np.asarray(img_lm478)[..., _lm478_from_image, :]
+    return combined
@@ -0,0 +1,89 @@
+import numpy as np
+
+from utils.landmark_layouts import index_eye_from_lm478, index_mouth_from_lm478, index_lm68_from_lm478
+from utils.landmark_tracking import interpolate_failed, SOURCE_DETECTED, SOURCE_FAILED
+
+# region -> (window, polyorder) of the Savitzky-Golay filter for single-pass lm478 tracks.
+# The contour, brows and nose are held steady like the VIDEO mode landmarker does, mouth and eyes stay responsive.
+# window 1 leaves a region untouched.
+DEFAULT_SMOOTHING = {
+    "mouth": (5, 3),
+    "eyes": (5, 3),
+    "rest": (11, 2),
+}
+
+
+def region_index_lm478():
+    index = {"mouth": np.unique(index_mouth_from_lm478), "eyes": np.unique(index_eye_from_lm478)}
+    index["rest"] = np.setdiff1d(np.arange(478), np.concatenate(list(index.values())))
+    return index
+
+
+def savgol_coeffs(window, polyorder):
+    # least squares polynomial fit over the window, evaluated at its center
+    half = window // 2
+    x = np.arange(-half, half + 1, dtype=np.float64)
+    A = np.vander(x, polyorder + 1, increasing=True)
+    return np.linalg.pinv(A)[0]
+
+
+def savgol_smooth(track, window, polyorder):
+    """
+    Savitzky-Golay filter along the time axis of a whole track at once.
+    track: [T, ...], window: odd number of frames, ends are padded by mirroring
+    """
+    track = np.asarray(track, dtype=np.float64)
+    window = min(window, len(track) if len(track) % 2 else len(track) - 1)
+    if window <= polyorder or window < 3:
+        return track.copy()
+    half = window // 2
+    padded = np.concatenate([track[half:0:-1], track, track[-2:-half - 2:-1]])
+    out = np.zeros_like(track)
+    # one multiply-add per tap over every point of every frame
+    for k, c in enumerate(savgol_coeffs(window, polyorder)):
+        out += c * padded[k:k + len(track)]
+    return out
+
+
+def smooth_lm478_track(track, smoothing=None, valid=None):
+    """
+    Per-region temporal smoothing of a [T, 478, 2] track.
+    smoothing: {region: (window, polyorder)}, regions as in region_index_lm478, defaults to DEFAULT_SMOOTHING
+    valid: [T] detection mask, failed frames are interpolated between the neighbouring detections before
+           filtering, failed frames at either end take the nearest detection
+    """
+    track = np.asarray(track, dtype=np.float64)
+    if valid is not None:
+        source = np.where(np.asarray(valid, dtype=bool), SOURCE_DETECTED, SOURCE_FAILED)
+        track, _ = interpolate_failed(track, source)
+    smoothing = {**DEFAULT_SMOOTHING, **(smoothing or {})}
+    out = np.empty_like(track)
+    for region, index in region_index_lm478().items():
+        window, polyorder = smoothing[region]
+        out[:, index] = savgol_smooth(track[:, index], window, polyorder)
+    return out
+
+
+def compare_landmark_tracks(reference, candidate):
+    """
+    Quality of a candidate [T, 478, 2] track against a reference one (e.g. single pass against dual pass),
+    per region and in the lm68 points the swap uses.
+    error: mean / p95 distance to the reference, in units of the reference inter-ocular distance
+    jitter: mean frame-to-frame acceleration of each track in the same units, lower is steadier
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    candidate = np.asarray(candidate, dtype=np.float64)
+    # outer eye corners 33 and 263
+    iod = np.maximum(np.linalg.norm(reference[:, 33] - reference[:, 263], axis=-1), 1e-6)[:, None]
+    regions = dict(region_index_lm478())
+    regions["lm68"] = np.asarray(index_lm68_from_lm478)
+    report = {}
+    for region, index in regions.items():
+        error = np.linalg.norm(candidate[:, index] - reference[:, index], axis=-1) / iod
+        entry = {"error_mean": float(error.mean()), "error_p95": float(np.percentile(error, 95))}
+        if len(reference) > 2:
+            for name, track in (("reference", reference), ("candidate", candidate)):
+                accel = np.linalg.norm(np.diff(track[:, index], n=2, axis=0), axis=-1) / iod[1:-1]
+                entry[f"jitter_{name}"] = float(accel.mean())
+        report[region] = {key: round(value, 5) for key, value in entry.items()}
+    return report
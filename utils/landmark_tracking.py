@@ -0,0 +1,89 @@
+import cv2
+import numpy as np
+
+from utils.metrics import metrics
+
+# per-frame source of a landmark track
+SOURCE_FAILED = 0  # neither detected nor tracked, repaired by interpolate_failed
+SOURCE_DETECTED = 1
+SOURCE_TRACKED = 2  # propagated from the previous frame by optical flow
+SOURCE_INTERPOLATED = 3
+SOURCE_NAMES = {SOURCE_FAILED: "failed", SOURCE_DETECTED: "detected", SOURCE_TRACKED: "tracked",
+                SOURCE_INTERPOLATED: "interpolated"}
+
+
+class FlowTracker:
+    """
+    Propagates landmarks from one frame to the next with pyramidal Lucas-Kanade optical flow.
+    Every fb_stride-th point is also tracked back, confidence is the share of those that come back within
+    max_fb_error pixels. Points the flow loses, or that move further than max_deviation of the face size
+    away from the median motion (e.g. sliding along the jaw line), follow the median motion instead.
+    win_size, max_level, iterations: LK window, pyramid depth and iteration limit
+    """
+
+    def __init__(self, win_size=15, max_level=2, iterations=10, max_fb_error=1.0, fb_stride=8, max_deviation=0.1):
+        self.lk_params = dict(winSize=(win_size, win_size), maxLevel=max_level,
+                              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, iterations, 0.03))
+        self.max_fb_error = max_fb_error
+        self.fb_stride = fb_stride
+        self.max_deviation = max_deviation
+
+    @staticmethod
+    def prepare(frame_rgb):
+        # converted once per frame, the image is the next frame of one step and the previous of the following one
+        return cv2.cvtColor(np.asarray(frame_rgb, dtype=np.uint8), cv2.COLOR_RGB2GRAY)
+
+    def _flow(self, prev_gray, gray, points):
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None, **self.lk_params)
+        return moved, status.reshape(-1).astype(bool)
+
+    def track(self, prev_gray, gray, points):
+        """
+        prev_gray, gray: consecutive frames from prepare()
+        points: [N, 2] in the previous frame
+        return: [N, 2] points in the current frame, confidence in [0, 1]
+        """
+        with metrics.timer("track"):
+            p0 = np.ascontiguousarray(points, dtype=np.float32).reshape(-1, 1, 2)
+            p1, found = self._flow(prev_gray, gray, p0)
+            # the backward check on a subset is enough to tell whether the face is still followed
+            probe = np.flatnonzero(found)[::self.fb_stride]
+            if len(probe) == 0:
+                return np.array(points, dtype=np.float64), 0.0
+            back, returned = self._flow(gray, prev_gray, np.ascontiguousarray(p1[probe]))
+            fb_error = np.linalg.norm((back - p0[probe]).reshape(-1, 2), axis=-1)
+            confidence = np.count_nonzero(returned & (fb_error < self.max_fb_error)) / len(p0[::self.fb_stride])
+            motion = (p1 - p0).reshape(-1, 2)
+            median = np.median(motion[found], axis=0)
+            face_size = np.ptp(points, axis=0).max()
+            inlier = found & (np.linalg.norm(motion - median, axis=-1) <= self.max_deviation * face_size)
+            tracked = np.array(points, dtype=np.float64)
+            tracked[inlier] += motion[inlier]
+            tracked[~inlier] += median
+        return tracked, float(min(confidence, inlier.mean()))
+
+
+def interpolate_failed(track, source):
+    """
+    Fill SOURCE_FAILED frames of track [T, N, 2] linearly between the neighbouring good frames,
+    failed frames at either end take the nearest good frame.
+    return: repaired track, source with the filled frames marked SOURCE_INTERPOLATED
+    """
+    track = np.array(track, dtype=np.float64)
+    source = np.array(source, dtype=np.uint8)
+    failed = np.flatnonzero(source == SOURCE_FAILED)
+    good = np.flatnonzero(source != SOURCE_FAILED)
+    if len(failed) == 0 or len(good) == 0:
+        return track, source
+    right = np.clip(np.searchsorted(good, failed), 0, len(good) - 1)
+    left = np.clip(right - 1, 0, len(good) - 1)
+    left_index, right_index = good[left], good[right]
+    span = np.maximum(right_index - left_index, 1)
+    weight = np.clip((failed - left_index) / span, 0.0, 1.0)[:, None, None]
+    track[failed] = (1 - weight) * track[left_index] + weight * track[right_index]
+    source[failed] = SOURCE_INTERPOLATED
+    return track, source
+
+
+def source_counts(source):
+    return {name: int(np.count_nonzero(np.asarray(source) == value)) for value, name in SOURCE_NAMES.items()}
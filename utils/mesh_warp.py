@@ -0,0 +1,208 @@
+import cv2
+import numpy as np
+
+
+def triangle_affine_coeffs(tri_src, tri_dst):
+    """
+    tri_src, tri_dst: [M, 3, 2]
+    return: [M, 3, 2] transposed affine matrices mapping dst (x, y, 1) to src (x, y),
+            and a [M] mask of the non-degenerate triangles
+    """
+    dst = np.concatenate([tri_dst, np.ones(tri_dst.shape[:2] + (1,))], axis=-1).astype(np.float64)
+    valid = np.abs(np.linalg.det(dst)) > 1e-6
+    dst[~valid] = np.eye(3)
+    coeffs = np.linalg.solve(dst, tri_src.astype(np.float64))
+    return coeffs, valid
+
+
+def triangles_overlapping(triangles, box):
+    """
+    triangles: [M, 3, 2], box: (x0, y0, x1, y1)
+    return: [M] mask of the triangles whose bounding box overlaps box
+    """
+    lo = triangles.min(axis=1)
+    hi = triangles.max(axis=1)
+    return (lo[:, 0] <= box[2]) & (hi[:, 0] >= box[0]) & (lo[:, 1] <= box[3]) & (hi[:, 1] >= box[1])
+
+
+class MeshWarper:
+    """
+    Warps a whole triangle mesh in a single pass.
+    A per-pixel triangle id map and the inverse affine of every triangle give one remap field over
+    the bounding box of the destination mesh, then the source is sampled with one cv2.remap into a
+    uint8 ROI buffer. The field is reused across frames while the mesh does not change.
+    incremental: keep the warped patch between calls, an unchanged mesh reuses it as is and a mesh
+                 where only some triangles changed re-rasterizes and re-samples just those triangles
+    """
+
+    def __init__(self, incremental=False, max_update_fraction=0.5):
+        self.incremental = incremental
+        self.max_update_fraction = max_update_fraction
+        self.tri_src = None
+        self.tri_dst = None
+        self.rect = None
+        self.label = None
+        self.coeffs = None
+        self.map_x = None
+        self.map_y = None
+        self.mask = None
+        self.buffer = None
+        self.buffer_valid = False
+        self.grid = None
+        self.rebuilds = 0
+        self.reuses = 0
+        self.updates = 0
+        self.triangles_warped = 0
+        self.triangles_reused = 0
+
+    def _grid(self, rect):
+        x, y, w, h = rect
+        if self.grid is None or self.grid[0].shape != (h, w):
+            self.grid = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+        xs, ys = self.grid
+        return xs + x, ys + y
+
+    def build(self, tri_src, tri_dst, dst_shape):
+        """
+        tri_src, tri_dst: [M, 3, 2] source and destination triangles
+        dst_shape: shape of the destination image, the field is clipped to it
+        """
+        tri_src = np.asarray(tri_src, dtype=np.float32)
+        tri_dst = np.asarray(tri_dst, dtype=np.float32)
+        x, y, w, h = cv2.boundingRect(tri_dst.reshape(-1, 2))
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, dst_shape[1]), min(y + h, dst_shape[0])
+        rect = (x0, y0, max(x1 - x0, 0), max(y1 - y0, 0))
+
+        coeffs, valid = triangle_affine_coeffs(tri_src, tri_dst)
+
+        # per-pixel triangle id, 0 is background
+        label = np.zeros((rect[3], rect[2]), dtype=np.uint16)
+        local = np.round((tri_dst - np.float32([x0, y0])) * 16).astype(np.int32)
+        for i in np.flatnonzero(valid):
+            cv2.fillConvexPoly(label, local[i], int(i) + 1, cv2.LINE_8, 4)
+
+        # background maps outside the source, it is masked out anyway
+        self.coeffs = np.concatenate([np.float64([[[0, 0], [0, 0], [-1, -1]]]), coeffs]).astype(np.float32)
+        self.label = label
+        self.rect = rect
+        xs, ys = self._grid(rect)
+        self.map_x, self.map_y = self._field(label, xs, ys)
+        self.mask = label > 0
+        self.tri_src = tri_src.copy()
+        self.tri_dst = tri_dst.copy()
+        self.buffer_valid = False
+        self.rebuilds += 1
+
+    def _field(self, label, xs, ys):
+        a = self.coeffs[label]  # [h, w, 3, 2]
+        return (a[..., 0, 0] * xs + a[..., 1, 0] * ys + a[..., 2, 0],
+                a[..., 0, 1] * xs + a[..., 1, 1] * ys + a[..., 2, 1])
+
+    def _changed(self, tri_src, tri_dst, dst_shape, dirty_box=None):
+        """
+        return: indices of the triangles that differ from the current mesh or overlap dirty_box,
+                None when only a full build will do
+        """
+        if (self.rect is None or tri_src.shape != self.tri_src.shape or tri_dst.shape != self.tri_dst.shape
+                or self.rect[0] + self.rect[2] > dst_shape[1] or self.rect[1] + self.rect[3] > dst_shape[0]):
+            return None
+        changed = (np.any(tri_src != self.tri_src, axis=(1, 2)) |
+                   np.any(tri_dst != self.tri_dst, axis=(1, 2)))
+        if dirty_box is not None:
+            changed |= triangles_overlapping(tri_src, dirty_box)
+        changed = np.flatnonzero(changed)
+        if len(changed) > self.max_update_fraction * len(tri_dst):
+            return None
+        # the changed triangles have to stay inside the current field
+        x, y, w, h = self.rect
+        lo = tri_dst[changed].reshape(-1, 2).min(axis=0, initial=np.inf)
+        hi = tri_dst[changed].reshape(-1, 2).max(axis=0, initial=-np.inf)
+        if len(changed) and (lo[0] < x or lo[1] < y or hi[0] > x + w - 1 or hi[1] > y + h - 1):
+            return None
+        return changed
+
+    def update(self, tri_src, tri_dst, changed):
+        """
+        Re-rasterize the changed triangles and refresh the field around them.
+        return: (rows, cols) slices of the refreshed part of the field and a lookup of the changed triangle ids
+        """
+        x, y, w, h = self.rect
+        changed_ids = np.zeros(len(self.coeffs), dtype=bool)
+        changed_ids[changed + 1] = True
+        # everything the changed triangles covered before and cover now
+        both = np.concatenate([self.tri_dst[changed], tri_dst[changed]]).reshape(-1, 2) - np.float32([x, y])
+        bx, by, bw, bh = cv2.boundingRect(both)
+        cols = slice(max(bx - 1, 0), min(bx + bw + 1, w))
+        rows = slice(max(by - 1, 0), min(by + bh + 1, h))
+        sub_label = self.label[rows, cols]
+        sub_label[changed_ids[sub_label]] = 0
+
+        coeffs, valid = triangle_affine_coeffs(tri_src[changed], tri_dst[changed])
+        self.coeffs[changed + 1] = coeffs
+        local = np.round((tri_dst[changed] - np.float32([x, y])) * 16).astype(np.int32)
+        for i, tri in zip(changed[valid], local[valid]):
+            cv2.fillConvexPoly(self.label, tri, int(i) + 1, cv2.LINE_8, 4)
+
+        xs, ys = self._grid(self.rect)
+        self.map_x[rows, cols], self.map_y[rows, cols] = self._field(sub_label, xs[rows, cols], ys[rows, cols])
+        self.mask[rows, cols] = sub_label > 0
+        self.tri_src[changed] = tri_src[changed]
+        self.tri_dst[changed] = tri_dst[changed]
+        self.updates += 1
+        return (rows, cols), changed_ids
+
+    def is_current(self, tri_src, tri_dst, dst_shape):
+        return (self.rect is not None
+                and self.rect[0] + self.rect[2] <= dst_shape[1] and self.rect[1] + self.rect[3] <= dst_shape[0]
+                and np.shape(tri_src) == self.tri_src.shape and np.shape(tri_dst) == self.tri_dst.shape
+                and np.array_equal(np.asarray(tri_src, dtype=np.float32), self.tri_src)
+                and np.array_equal(np.asarray(tri_dst, dtype=np.float32), self.tri_dst))
+
+    def warp(self, img_src, img_dst, tri_src, tri_dst, dirty_box=None):
+        """
+        Warp every triangle of img_src onto img_dst in place.
+        tri_src, tri_dst: [M, 3, 2]
+        dirty_box: (x0, y0, x1, y1) region of img_src whose content changed although the mesh did not,
+                   incremental mode samples the triangles overlapping it again
+        """
+        tri_src = np.asarray(tri_src, dtype=np.float32)
+        tri_dst = np.asarray(tri_dst, dtype=np.float32)
+        changed = self._changed(tri_src, tri_dst, img_dst.shape, dirty_box) if self.incremental else None
+        refreshed = None
+        if changed is not None and len(changed):
+            refreshed = self.update(tri_src, tri_dst, changed)
+        elif changed is not None:
+            self.reuses += 1
+        elif self.is_current(tri_src, tri_dst, img_dst.shape):
+            # too much of the patch changed in incremental mode, sample it all again
+            self.buffer_valid = False
+            self.reuses += 1
+        else:
+            self.build(tri_src, tri_dst, img_dst.shape)
+        x, y, w, h = self.rect
+        if w == 0 or h == 0:
+            return img_dst
+        if self.buffer is None or self.buffer.shape != (h, w) + img_src.shape[2:] or self.buffer.dtype != img_src.dtype:
+            self.buffer = np.empty((h, w) + img_src.shape[2:], dtype=img_src.dtype)
+            self.buffer_valid = False
+        if not (self.incremental and self.buffer_valid):
+            cv2.remap(img_src, self.map_x, self.map_y, cv2.INTER_LINEAR, dst=self.buffer,
+                      borderMode=cv2.BORDER_REFLECT_101)
+            self.buffer_valid = True
+            self.triangles_warped += len(tri_dst)
+        elif refreshed is not None:
+            # only the pixels of the changed triangles are sampled again
+            (rows, cols), changed_ids = refreshed
+            sub = cv2.remap(img_src, self.map_x[rows, cols], self.map_y[rows, cols], cv2.INTER_LINEAR,
+                            borderMode=cv2.BORDER_REFLECT_101)
+            where = changed_ids[self.label[rows, cols]]
+            np.copyto(self.buffer[rows, cols], sub, where=where if sub.ndim == 2 else where[..., None])
+            self.triangles_warped += len(changed)
+            self.triangles_reused += len(tri_dst) - len(changed)
+        else:
+            self.triangles_reused += len(tri_dst)
+        roi = img_dst[y:y + h, x:x + w]
+        mask = self.mask if roi.ndim == 2 else self.mask[..., None]
+        np.copyto(roi, self.buffer, where=mask)
+        return img_dst
@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+import time
+
+# histogram bucket upper bounds in seconds
+TIMER_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float("inf"))
+
+
+def _new_timer():
+    return {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(TIMER_BUCKETS)}
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    """
+    Opt-in per-stage timers, histograms and counters for swap jobs.
+    While disabled timer() hands out a shared no-op context manager and inc() returns at once,
+    so the instrumentation can stay in the hot path.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timers = {}
+
+    def timer(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = _new_timer()
+            timer["count"] += 1
+            timer["sum"] += seconds
+            timer["max"] = max(timer["max"], seconds)
+            for i, bound in enumerate(TIMER_BUCKETS):
+                if seconds <= bound:
+                    timer["buckets"][i] += 1
+                    break
+
+    def inc(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def drain(self):
+        """
+        Hand over the raw state and start afresh, used to ship worker process metrics to the parent.
+        """
+        with self._lock:
+            state = {"counters": self.counters, "timers": self.timers}
+            self.counters = {}
+            self.timers = {}
+        return state
+
+    def merge(self, state):
+        with self._lock:
+            for name, value in state["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in state["timers"].items():
+                timer = self.timers.get(name)
+                if timer is None:
+                    timer = self.timers[name] = _new_timer()
+                timer["count"] += other["count"]
+                timer["sum"] += other["sum"]
+                timer["max"] = max(timer["max"], other["max"])
+                timer["buckets"] = [a + b for a, b in zip(timer["buckets"], other["buckets"])]
+
+    def summary(self):
+        with self._lock:
+            timers = {}
+            for name, timer in self.timers.items():
+                timers[name] = {
+                    "count": timer["count"],
+                    "total_s": round(timer["sum"], 6),
+                    "mean_ms": round(1000 * timer["sum"] / timer["count"], 3),
+                    "max_ms": round(1000 * timer["max"], 3),
+                    "histogram": {("+Inf" if bound == float("inf") else str(bound)): count
+                                  for bound, count in zip(TIMER_BUCKETS, timer["buckets"])},
+                }
+            return {"timers": timers, "counters": dict(self.counters)}
+
+    def export_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def export_prometheus(self, path, prefix="faceswap"):
+        lines = []
+        with self._lock:
+            if self.timers:
+                lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+            for name, timer in sorted(self.timers.items()):
+                cumulative = 0
+                for bound, count in zip(TIMER_BUCKETS, timer["buckets"]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {timer["sum"]!r}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {timer["count"]}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+# process-wide instance used by the library, off unless FACESWAP_METRICS=1 or metrics.enable()
+metrics = Metrics(enabled=os.environ.get("FACESWAP_METRICS", "0") == "1")
+
+
+def export_job_metrics(output_path):
+    """
+    At the end of a job write output_path.metrics.json and output_path.prom when metrics are enabled.
+    """
+    if not metrics.enabled:
+        return
+    metrics.export_json(output_path + ".metrics.json")
+    metrics.export_prometheus(output_path + ".prom")
@@ -0,0 +1,139 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from utils.face_swap_utils import face_swap_frames, FaceSwapper
+from utils.frame_source import VideoFrameSource
+from utils.landmark_io import load_landmark_track
+from utils.metrics import metrics, export_job_metrics
+from utils.video_util import FFmpegWriter
+
+# per-process state of a pool worker, set up once by _init_worker
+_worker = {}
+
+
+def _attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 has no track flag, the parent owns and unlinks the block anyway
+        return shared_memory.SharedMemory(name=name)
+
+
+def _init_worker(source_name, source_shape, target_name, target_shape, blend_mode, motion_threshold=None,
+                 metrics_enabled=False):
+    source_shm = _attach_shared_memory(source_name)
+    target_shm = _attach_shared_memory(target_name)
+    _worker['shm'] = (source_shm, target_shm)
+    _worker['source'] = np.ndarray(source_shape, dtype=np.uint8, buffer=source_shm.buf)
+    _worker['target'] = np.ndarray(target_shape, dtype=np.uint8, buffer=target_shm.buf)
+    # every worker keeps its own triangulation and remap caches
+    _worker['swapper'] = FaceSwapper(blend_mode, motion_threshold)
+    metrics.reset()
+    metrics.enabled = metrics_enabled
+
+
+def _swap_slot(slot, index, points1, points2):
+    target = _worker['target']
+    target[slot] = _worker['swapper'].swap(_worker['source'][slot], target[slot], points1, points2)
+    # worker metrics ride back with each result and are merged into the parent's
+    return index, slot, metrics.drain() if metrics.enabled else None
+
+
+def swap_video(source_video, target_video, source_lm, target_lm, output_video, workers=None, fps=None,
+               slots_per_worker=2, blend_mode="normal", encoder_options=None, motion_threshold=None,
+               audio=None):
+    """
+    Swap the face of source_video onto target_video frame by frame across a process pool.
+    source_lm, target_lm: landmark track or json paths, or per-frame 68 point arrays
+    blend_mode: see face_swap_utils.blend_face
+    encoder_options: keyword arguments for video_util.FFmpegWriter, e.g. codec, preset, crf, threads
+    motion_threshold: reuse the warped face on near-static frames, see face_swap_utils.FaceSwapper.
+                      Sequential only (workers=1), a worker sees every n-th frame and would reuse the patch of
+                      a frame further back, with more workers it is turned off.
+    audio: audio source muxed into the output while encoding, e.g. target_video, see video_util.FFmpegWriter
+    Frames travel to the workers through a ring of shared memory slots, results are written back in place
+    and handed to the encoder strictly in frame order.
+    With metrics enabled the job's stage timings are written next to output_video, see utils.metrics.
+    return: number of frames written
+    """
+    if isinstance(source_lm, str):
+        source_lm = load_landmark_track(source_lm)
+    if isinstance(target_lm, str):
+        target_lm = load_landmark_track(target_lm)
+    source_frames = VideoFrameSource(source_video)
+    target_frames = VideoFrameSource(target_video)
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and motion_threshold is not None:
+        print(f"Warning: motion_threshold needs consecutive frames, ignored with {workers} workers")
+        motion_threshold = None
+    writer = FFmpegWriter(output_video, target_frames.width, target_frames.height, fps or target_frames.fps or 25,
+                          audio=audio, **(encoder_options or {}))
+
+    if workers <= 1:
+        count = 0
+        for result in face_swap_frames(source_frames, target_frames, source_lm, target_lm, blend_mode,
+                                       motion_threshold):
+            writer.write(result)
+            count += 1
+        writer.close()
+        export_job_metrics(output_video)
+        return count
+
+    n_slots = workers * slots_per_worker
+    source_shape = (n_slots, source_frames.height, source_frames.width, 3)
+    target_shape = (n_slots, target_frames.height, target_frames.width, 3)
+    source_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(source_shape)))
+    target_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(target_shape)))
+    source = np.ndarray(source_shape, dtype=np.uint8, buffer=source_shm.buf)
+    target = np.ndarray(target_shape, dtype=np.uint8, buffer=target_shm.buf)
+
+    free = deque(range(n_slots))
+    running = set()
+    ready = {}
+    next_index = 0
+
+    def collect():
+        nonlocal next_index
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+            running.remove(future)
+            index, slot, worker_metrics = future.result()
+            if worker_metrics is not None:
+                metrics.merge(worker_metrics)
+            ready[index] = slot
+        # hand frames to the encoder strictly in sequence
+        while next_index in ready:
+            slot = ready.pop(next_index)
+            writer.write(target[slot])
+            free.append(slot)
+            next_index += 1
+
+    try:
+        # spawn, a fork would copy locks (e.g. the metrics lock) held by the frame decoder threads
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker,
+                                 initargs=(source_shm.name, source_shape, target_shm.name, target_shape,
+                                           blend_mode, motion_threshold, metrics.enabled)) as pool:
+            frames = zip(source_frames, target_frames, source_lm, target_lm)
+            for index, (img1, img2, points1, points2) in enumerate(frames):
+                while not free:
+                    collect()
+                slot = free.popleft()
+                source[slot] = img1
+                target[slot] = img2
+                running.add(pool.submit(_swap_slot, slot, index, points1, points2))
+            while running:
+                collect()
+    finally:
+        writer.close()
+        del source, target
+        source_shm.close()
+        source_shm.unlink()
+        target_shm.close()
+        target_shm.unlink()
+    export_job_metrics(output_video)
+    return next_index
@@ -0,0 +1,220 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+from utils.face_landmarker import MediapipeLandmarker
+from utils.face_swap_utils import FaceSwapper
+from utils.frame_source import VideoFrameSource
+from utils.landmark_io import write_landmarks
+from utils.metrics import export_job_metrics
+from utils.video_util import FFmpegWriter
+
+# end of stream marker passed down the queues
+_END = object()
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class FaceSwapPipeline:
+    """
+    Single-pass video face swap, every stage runs on its own thread and stages are joined by bounded queues:
+
+        decode source -> landmarks source --+
+                                            +--> swap -> encode
+        decode target -> landmarks target --+
+
+    Each video is decoded once, landmarks only go to disk when a save path is given.
+    stats() reports per-stage busy/wait time and mean queue depth, the stage in front of the fullest
+    queue is the bottleneck, plus the warp reuse of the swap stage.
+    """
+
+    def __init__(self, source_video, target_video, output_video, fps=None, anti_smooth_factor=2, track_roi=False,
+                 queue_size=8, source_landmarks_path=None, target_landmarks_path=None, blend_mode="normal",
+                 encoder_options=None, motion_threshold=None, audio=None):
+        self.source_video = source_video
+        self.target_video = target_video
+        self.output_video = output_video
+        self.fps = fps
+        self.anti_smooth_factor = anti_smooth_factor
+        self.track_roi = track_roi
+        self.blend_mode = blend_mode
+        self.encoder_options = encoder_options or {}
+        self.motion_threshold = motion_threshold
+        self.audio = audio
+        self.landmarks_paths = {"source": source_landmarks_path, "target": target_landmarks_path}
+        self.queues = {name: queue.Queue(maxsize=queue_size)
+                       for name in ("source_frames", "target_frames", "source_landmarks", "target_landmarks",
+                                    "swapped")}
+        self.depth_samples = {name: [0, 0] for name in self.queues}
+        self.stage_stats = {}
+        self.swap_stats = {}
+        self._stop = threading.Event()
+        self._errors = []
+
+    def queue_depths(self):
+        return {name: q.qsize() for name, q in self.queues.items()}
+
+    def stats(self):
+        stages = {}
+        for name, st in self.stage_stats.items():
+            busy = max(st["wall"] - st["wait"], 0.0)
+            stages[name] = {
+                "frames": st["frames"],
+                "busy_s": round(busy, 3),
+                "wait_s": round(st["wait"], 3),
+                "fps": round(st["frames"] / busy, 2) if busy > 0 else None,
+            }
+        queues = {name: round(total / count, 2) if count else 0.0
+                  for name, (total, count) in self.depth_samples.items()}
+        return {"stages": stages, "mean_queue_depth": queues, "swap": self.swap_stats}
+
+    def _put(self, stage, name, item):
+        q = self.queues[name]
+        start = time.perf_counter()
+        try:
+            while True:
+                if self._stop.is_set():
+                    raise PipelineStopped()
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+        finally:
+            self.stage_stats[stage]["wait"] += time.perf_counter() - start
+
+    def _get(self, stage, name):
+        q = self.queues[name]
+        samples = self.depth_samples[name]
+        samples[0] += q.qsize()
+        samples[1] += 1
+        start = time.perf_counter()
+        try:
+            while True:
+                if self._stop.is_set():
+                    raise PipelineStopped()
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        finally:
+            self.stage_stats[stage]["wait"] += time.perf_counter() - start
+
+    def _iter_queue(self, stage, name):
+        while True:
+            item = self._get(stage, name)
+            if item is _END:
+                return
+            yield item
+
+    def _thread(self, stage, target, *args):
+        self.stage_stats[stage] = {"frames": 0, "wall": 0.0, "wait": 0.0}
+
+        def run():
+            start = time.perf_counter()
+            try:
+                target(stage, *args)
+            except PipelineStopped:
+                pass
+            except BaseException as e:
+                self._errors.append((stage, e))
+                self._stop.set()
+            finally:
+                self.stage_stats[stage]["wall"] = time.perf_counter() - start
+
+        return threading.Thread(target=run, name=f"faceswap-{stage}", daemon=True)
+
+    def _decode_stage(self, stage, frames, out_name):
+        for frame in frames:
+            self.stage_stats[stage]["frames"] += 1
+            self._put(stage, out_name, frame)
+        self._put(stage, out_name, _END)
+
+    def _landmark_stage(self, stage, side, frames, in_name, out_name):
+        save_path = self.landmarks_paths[side]
+        saved, saved_valid = [], []
+        current = {}
+
+        def consume():
+            for frame in self._iter_queue(stage, in_name):
+                current["frame"] = frame
+                yield frame
+
+        with MediapipeLandmarker() as landmarker:
+            results = landmarker.iter_lm478_from_frames(consume(), self.fps or frames.fps or 25,
+                                                        self.anti_smooth_factor, self.track_roi)
+            for img_lm, vid_lm, ok in results:
+                lm68 = landmarker.combine_vid_img_lm478_to_lm68(img_lm[None], vid_lm[None])[0]
+                if save_path is not None:
+                    saved.append(lm68)
+                    saved_valid.append(ok)
+                self.stage_stats[stage]["frames"] += 1
+                self._put(stage, out_name, (current["frame"], lm68))
+        self._put(stage, out_name, _END)
+        if save_path is not None:
+            write_landmarks(save_path, np.reshape(saved, (-1, 68, 2)), "lm68", frames.fps or 25,
+                            (frames.width, frames.height), saved_valid)
+
+    def _swap_stage(self, stage):
+        swapper = FaceSwapper(self.blend_mode, self.motion_threshold)
+        ended = {"source_landmarks": False, "target_landmarks": False}
+        while not any(ended.values()):
+            source = self._get(stage, "source_landmarks")
+            target = self._get(stage, "target_landmarks")
+            ended = {"source_landmarks": source is _END, "target_landmarks": target is _END}
+            if any(ended.values()):
+                break
+            img1, points1 = source
+            img2, points2 = target
+            self._put(stage, "swapped", swapper.swap(img1, img2, points1, points2))
+            self.stage_stats[stage]["frames"] += 1
+        self.swap_stats = swapper.stats()
+        self._put(stage, "swapped", _END)
+        # the longer side only has to run to the end when its landmarks are saved
+        for name, side in (("source_landmarks", "source"), ("target_landmarks", "target")):
+            if not ended[name] and self.landmarks_paths[side] is not None:
+                for _ in self._iter_queue(stage, name):
+                    pass
+
+    def _encode_stage(self, stage, frames, fps):
+        writer = FFmpegWriter(self.output_video, frames.width, frames.height, fps, audio=self.audio,
+                              **self.encoder_options)
+        try:
+            for frame in self._iter_queue(stage, "swapped"):
+                writer.write(frame)
+                self.stage_stats[stage]["frames"] += 1
+        finally:
+            writer.close()
+
+    def run(self):
+        source_frames = VideoFrameSource(self.source_video)
+        target_frames = VideoFrameSource(self.target_video)
+        encode = self._thread("encode", self._encode_stage, target_frames, self.fps or target_frames.fps or 25)
+        swap = self._thread("swap", self._swap_stage)
+        threads = [
+            self._thread("decode_source", self._decode_stage, source_frames, "source_frames"),
+            self._thread("decode_target", self._decode_stage, target_frames, "target_frames"),
+            self._thread("landmarks_source", self._landmark_stage, "source", source_frames, "source_frames",
+                         "source_landmarks"),
+            self._thread("landmarks_target", self._landmark_stage, "target", target_frames, "target_frames",
+                         "target_landmarks"),
+            swap,
+            encode,
+        ]
+        for thread in threads:
+            thread.start()
+        encode.join()
+        swap.join()
+        # the swap is done, release whatever is still decoding the longer video
+        self._stop.set()
+        for thread in threads:
+            thread.join()
+        if self._errors:
+            stage, error = self._errors[0]
+            raise RuntimeError(f"face swap pipeline stage '{stage}' failed") from error
+        export_job_metrics(self.output_video)
+        return self.stats()
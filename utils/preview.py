@@ -0,0 +1,120 @@
+import subprocess
+import time
+
+import numpy as np
+
+from utils.face_swap_utils import face_swap_frames
+from utils.frame_source import VideoFrameSource
+from utils.landmark_io import save_landmark_track
+from utils.landmark_tracking import interpolate_failed, SOURCE_DETECTED, SOURCE_FAILED
+from utils.metrics import metrics
+from utils.video_util import FFmpegWriter, get_ffmpeg_exe
+
+
+class ProxyFrameSource:
+    """
+    Streams every frame_step-th frame of a video downscaled by scale, as RGB uint8 arrays.
+    ffmpeg drops and scales the frames before they are converted to RGB, the full-resolution frames
+    never reach python. Proxy sizes are rounded to even numbers.
+    """
+
+    def __init__(self, video_name, scale=0.25, frame_step=1):
+        full = VideoFrameSource(video_name)
+        self.video_name = video_name
+        self.scale = scale
+        self.frame_step = max(1, int(frame_step))
+        self.full_size = (full.width, full.height)
+        self.full_frame_count = len(full)
+        self.width = max(2, int(round(full.width * scale / 2)) * 2)
+        self.height = max(2, int(round(full.height * scale / 2)) * 2)
+        self.fps = (full.fps or 25) / self.frame_step
+
+    @property
+    def to_full(self):
+        # multiply proxy pixel coordinates by this to get full-resolution ones
+        return np.float64([self.full_size[0] / self.width, self.full_size[1] / self.height])
+
+    def __len__(self):
+        return -(-self.full_frame_count // self.frame_step)
+
+    def __iter__(self):
+        vf = f"select=not(mod(n\\,{self.frame_step})),scale={self.width}:{self.height}:flags=area"
+        cmd = [get_ffmpeg_exe(), "-nostdin", "-hide_banner", "-loglevel", "error", "-i", self.video_name,
+               "-an", "-vf", vf, "-fps_mode", "passthrough", "-f", "rawvideo", "-pix_fmt", "rgb24", "-"]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+                with metrics.timer("decode"):
+                    read = process.stdout.readinto(memoryview(frame).cast("B"))
+                if read < frame.nbytes:
+                    break
+                yield frame
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+
+
+def full_resolution_track(lm68, valid, frames):
+    """
+    Landmarks detected on the proxies of a ProxyFrameSource, moved back to full-resolution pixels
+    and to every frame of the full video. Frames skipped by frame_step are interpolated.
+    return: points [T, 68, 2], valid [T], True on the frames a detection succeeded on
+    """
+    index = np.arange(len(lm68)) * frames.frame_step
+    count = max(frames.full_frame_count, index[-1] + 1 if len(index) else 0)
+    points = np.zeros((count, 68, 2))
+    points[index] = np.asarray(lm68, dtype=np.float64) * frames.to_full
+    source = np.full(count, SOURCE_FAILED, dtype=np.uint8)
+    source[index] = SOURCE_DETECTED
+    points, _ = interpolate_failed(points, source)
+    full_valid = np.zeros(count, dtype=bool)
+    full_valid[index] = valid
+    return points, full_valid
+
+
+def render_preview(source_video, target_video, output_video, scale=0.25, frame_step=1, fps=25, anti_smooth_factor=2,
+                   landmark_mode="dual", blend_mode="normal", motion_threshold=None, landmarks_prefix=None,
+                   encoder_options=None):
+    """
+    Quick look at a swap: landmarks and face swap on proxies downscaled by scale, optionally only on every
+    frame_step-th frame, written to output_video at the proxy size. The preview plays at normal speed.
+    fps, anti_smooth_factor, landmark_mode: as for MediapipeLandmarker.extract_lm478_from_frames, fps is
+                                            divided by frame_step so VIDEO mode sees the same time steps
+    landmarks_prefix: the landmarks are saved as landmarks_prefix + ".source.lmk" / ".target.lmk",
+                      68 point tracks in full-resolution pixels for every frame, default output_video.
+                      The final render reads them, e.g. parallel_swap.swap_video(..., source_lm, target_lm),
+                      and skips detection.
+    return: {"preview", "source_landmarks", "target_landmarks", "frames", "seconds"}
+    """
+    from utils.face_landmarker import MediapipeLandmarker
+
+    start = time.perf_counter()
+    landmarks_prefix = landmarks_prefix or output_video
+    proxies = {"source": ProxyFrameSource(source_video, scale, frame_step),
+               "target": ProxyFrameSource(target_video, scale, frame_step)}
+    proxy_lm68 = {}
+    report = {"preview": output_video}
+    with MediapipeLandmarker() as landmarker:
+        for side, frames in proxies.items():
+            imgs, vids, valid = landmarker.extract_lm478_from_frames(frames, fps / frames.frame_step,
+                                                                     anti_smooth_factor, return_valid=True,
+                                                                     mode=landmark_mode)
+            proxy_lm68[side] = landmarker.combine_vid_img_lm478_to_lm68(imgs, vids)
+            points, full_valid = full_resolution_track(proxy_lm68[side], valid, frames)
+            path = f"{landmarks_prefix}.{side}.lmk"
+            save_landmark_track(path, points, "lm68", frames.fps * frames.frame_step, frames.full_size, full_valid)
+            report[f"{side}_landmarks"] = path
+
+    target = proxies["target"]
+    encoder_options = {"crf": 28, **(encoder_options or {})}
+    count = 0
+    with FFmpegWriter(output_video, target.width, target.height, target.fps, **encoder_options) as writer:
+        for result in face_swap_frames(proxies["source"], target, proxy_lm68["source"], proxy_lm68["target"],
+                                       blend_mode, motion_threshold):
+            writer.write(result)
+            count += 1
+    report["frames"] = count
+    report["seconds"] = round(time.perf_counter() - start, 2)
+    return report
@@ -0,0 +1,221 @@
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.face_swap_utils import FaceSwapper
+from utils.frame_source import VideoFrameSource
+from utils.video_util import FFmpegWriter, audio_params, get_ffmpeg_exe, pick_encoder
+
+
+def keyframe_indices(video_path, fps):
+    """
+    Frame indices of the keyframes of video_path, read from ffmpeg's showinfo over the keyframes only.
+    return: sorted list, empty when ffmpeg cannot tell
+    """
+    cmd = [get_ffmpeg_exe(), "-hide_banner", "-nostats", "-skip_frame", "nokey", "-i", video_path,
+           "-an", "-vf", "showinfo", "-f", "null", "-"]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        return []
+    times = [float(t) for t in re.findall(r"pts_time:(-?[0-9.]+)", result.stderr)]
+    return sorted({int(round(t * fps)) for t in times})
+
+
+def plan_segments(num_frames, segment_frames, keyframes=()):
+    """
+    Split [0, num_frames) into segments of about segment_frames frames.
+    A cut moves to a keyframe within a quarter segment of it, so the segment decoders start on a keyframe,
+    otherwise it stays where it is and the decoder seeks.
+    return: [(start, stop)]
+    """
+    segment_frames = max(1, int(segment_frames))
+    slack = segment_frames // 4
+    cuts = [0]
+    target = segment_frames
+    while target < num_frames:
+        near = [k for k in keyframes if abs(k - target) <= slack and cuts[-1] < k < num_frames]
+        cut = min(near, key=lambda k: abs(k - target)) if near else target
+        cuts.append(cut)
+        target = cut + segment_frames
+    cuts.append(num_frames)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def run_segment_job(job_path):
+    """
+    Landmarks and face swap of one segment, described by a job file written by write_segment_jobs.
+    Only the filesystem is shared, so jobs can run in a local pool or on other nodes.
+    The segment is written to a temporary file and renamed when complete, a finished segment is skipped.
+    return: number of frames written
+    """
+    from utils.face_landmarker import MediapipeLandmarker
+
+    with open(job_path) as f:
+        job = json.load(f)
+    if os.path.exists(job["output"]):
+        return job["stop"] - job["start"]
+
+    # the tracker starts warmup frames early, those frames are detected but not swapped
+    first = max(job["start"] - job["warmup"], 0)
+    source_frames = VideoFrameSource(job["source_video"], start=first, stop=job["stop"])
+    target_frames = VideoFrameSource(job["target_video"], start=first, stop=job["stop"])
+    swapper = FaceSwapper(job["blend_mode"], job["motion_threshold"])
+    tmp_path = job["output"] + ".part.mp4"
+    count = 0
+    # each video is decoded once, the landmarkers pull the frames and the swap reuses the frame just detected on
+    current = {}
+
+    def consume(side, frames):
+        for frame in frames:
+            current[side] = frame
+            yield frame
+
+    with MediapipeLandmarker() as source_landmarker, MediapipeLandmarker() as target_landmarker:
+        # job["fps"] only spaces the VIDEO mode timestamps, the segment keeps the video's own frame rate
+        source_lm = source_landmarker.iter_lm478_from_frames(consume("source", source_frames), job["fps"],
+                                                             job["anti_smooth_factor"], job["track_roi"],
+                                                             start_index=first)
+        target_lm = target_landmarker.iter_lm478_from_frames(consume("target", target_frames), job["fps"],
+                                                             job["anti_smooth_factor"], job["track_roi"],
+                                                             start_index=first)
+        writer = FFmpegWriter(tmp_path, target_frames.width, target_frames.height, target_frames.fps or 25,
+                              **job["encoder_options"])
+        try:
+            frames = zip(source_lm, target_lm)
+            for index, ((img_lm1, vid_lm1, _), (img_lm2, vid_lm2, _)) in enumerate(frames, first):
+                if index < job["start"]:
+                    continue
+                points1 = source_landmarker.combine_vid_img_lm478_to_lm68(img_lm1[None], vid_lm1[None])[0]
+                points2 = target_landmarker.combine_vid_img_lm478_to_lm68(img_lm2[None], vid_lm2[None])[0]
+                writer.write(swapper.swap(current["source"], current["target"], points1, points2))
+                count += 1
+        finally:
+            writer.close()
+    os.replace(tmp_path, job["output"])
+    return count
+
+
+def write_segment_jobs(source_video, target_video, work_dir, segment_seconds=20, overlap_frames=10, fps=None,
+                       anti_smooth_factor=2, track_roi=False, blend_mode="normal", motion_threshold=None,
+                       encoder_options=None):
+    """
+    Plan the segments of a swap and write one job file per segment into work_dir.
+    The encoder is fixed here, every segment has to come out with the same codec for the stream copy concat.
+    A segment's output name carries a hash of its job (inputs, frame range, options), so a rerun into the same
+    work_dir only resumes segments of the same plan. Segments and jobs of an earlier, different plan are removed.
+    return: job file paths in playback order
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    source_frames = VideoFrameSource(source_video)
+    target_frames = VideoFrameSource(target_video)
+    video_fps = target_frames.fps or 25
+    num_frames = min(len(source_frames), len(target_frames))
+    segments = plan_segments(num_frames, segment_seconds * video_fps, keyframe_indices(target_video, video_fps))
+    encoder_options = dict(encoder_options or {})
+    encoder_options.setdefault("codec", pick_encoder())
+
+    job_paths = []
+    outputs = set()
+    for i, (start, stop) in enumerate(segments):
+        job = {
+            "source_video": os.path.abspath(source_video),
+            "target_video": os.path.abspath(target_video),
+            "inputs": [_file_identity(source_video), _file_identity(target_video)],
+            "start": start,
+            "stop": stop,
+            "warmup": overlap_frames,
+            "fps": fps or video_fps,
+            "anti_smooth_factor": anti_smooth_factor,
+            "track_roi": track_roi,
+            "blend_mode": blend_mode,
+            "motion_threshold": motion_threshold,
+            "encoder_options": encoder_options,
+        }
+        key = hashlib.sha256(json.dumps(job, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        job["output"] = os.path.abspath(os.path.join(work_dir, f"segment_{i:05d}_{key}.mp4"))
+        outputs.add(job["output"])
+        job_path = os.path.join(work_dir, f"segment_{i:05d}.json")
+        with open(job_path, "w") as f:
+            json.dump(job, f, indent=2)
+        job_paths.append(job_path)
+    # leftovers of another plan must not be resumed or concatenated
+    for path in glob.glob(os.path.join(work_dir, "segment_*.mp4")):
+        if os.path.abspath(path) not in outputs:
+            os.remove(path)
+    for path in glob.glob(os.path.join(work_dir, "segment_*.json")):
+        if path not in job_paths:
+            os.remove(path)
+    return job_paths
+
+
+def _file_identity(path):
+    # size and modification time, a replaced input video invalidates the finished segments
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def concat_segments(segment_paths, output_path, audio=None, shortest=False):
+    """
+    Join segments with ffmpeg's concat demuxer, the streams are copied, not re-encoded.
+    audio: audio source muxed in by the same pass, copied when the container allows it
+    shortest: cut the output at the end of the shorter of video and audio, by default both are kept whole
+    """
+    list_path = output_path + ".segments.txt"
+    with open(list_path, "w") as f:
+        for path in segment_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    cmd = [get_ffmpeg_exe(), "-y", "-nostdin", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path]
+    if audio is not None:
+        cmd += ["-i", audio, "-map", "0:v:0", "-map", "1:a:0?"] + audio_params(audio, output_path, shortest=shortest)
+    cmd += ["-c:v", "copy", output_path]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg concat failed: {result.stderr}")
+    finally:
+        os.remove(list_path)
+
+
+def swap_video_segments(source_video, target_video, output_video, workers=None, segment_seconds=20,
+                        overlap_frames=10, work_dir=None, keep_segments=False, audio=None, **job_options):
+    """
+    Segment-parallel face swap: the videos are cut into time segments (on keyframes where possible),
+    every segment runs landmarks and face swap in its own process with its own landmarkers, and the
+    encoded segments are concatenated without re-encoding.
+    overlap_frames: frames before each segment that only warm up the VIDEO mode tracker
+    work_dir: job and segment files, default output_video + ".segments"; rerunning with the same inputs and
+              options skips finished segments
+    audio: audio source muxed in while the segments are joined, e.g. target_video
+    job_options: fps, anti_smooth_factor, track_roi, blend_mode, motion_threshold, encoder_options
+    return: number of frames written
+    """
+    work_dir = work_dir or output_video + ".segments"
+    job_paths = write_segment_jobs(source_video, target_video, work_dir, segment_seconds, overlap_frames,
+                                   **job_options)
+    workers = min(workers or os.cpu_count() or 1, len(job_paths))
+    # spawn, mediapipe graphs do not survive a fork
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        count = sum(pool.map(run_segment_job, job_paths))
+    segment_paths = []
+    for job_path in job_paths:
+        with open(job_path) as f:
+            segment_paths.append(json.load(f)["output"])
+    concat_segments(segment_paths, output_video, audio)
+    if not keep_segments:
+        shutil.rmtree(work_dir)
+    return count
+
+
+if __name__ == "__main__":
+    # run job files on this node: python -m utils.segment_swap work_dir/segment_*.json
+    for pattern in sys.argv[1:]:
+        for path in sorted(glob.glob(pattern)):
+            print(f"{path}: {run_segment_job(path)} frames")
@@ -1,9 +1,175 @@
 import os
+import re
 import subprocess
+import time
+from collections import OrderedDict
 import cv2
+import imageio_ffmpeg
 import numpy as np
 from moviepy.editor import VideoFileClip, clips_array
 
+from utils.metrics import metrics
+
+# first working encoder wins, nvenc is only usable on nodes with an nvidia gpu
+ENCODER_PREFERENCE = ("h264_nvenc", "libx264", "mpeg4")
+_encoder_available = {}
+# audio codecs each container takes as a stream copy, anything else is encoded to aac
+COPY_AUDIO_CODECS = {
+    ".mp4": {"aac", "mp3", "alac", "ac3"},
+    ".m4v": {"aac", "mp3", "alac", "ac3"},
+    ".mov": {"aac", "mp3", "alac", "ac3", "pcm_s16le", "pcm_s24le"},
+    ".mkv": None,  # takes anything
+    ".avi": {"mp3", "ac3", "pcm_s16le"},
+}
+
+
+def get_ffmpeg_exe():
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+def probe_encoder(codec):
+    # listing in `ffmpeg -encoders` is not enough (nvenc is listed on cpu-only nodes), so encode a few frames
+    if codec not in _encoder_available:
+        command = [get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error", "-f", "lavfi",
+                   "-i", "color=c=black:s=256x256:r=25", "-frames:v", "3", "-c:v", codec, "-f", "null", "-"]
+        try:
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+            _encoder_available[codec] = result.returncode == 0
+        except (OSError, subprocess.TimeoutExpired):
+            _encoder_available[codec] = False
+    return _encoder_available[codec]
+
+
+def pick_encoder(preference=ENCODER_PREFERENCE):
+    for codec in preference:
+        if probe_encoder(codec):
+            return codec
+    raise RuntimeError(f"none of the encoders {list(preference)} is available")
+
+
+def probe_audio_codec(path):
+    """
+    return: codec name of the first audio stream of path, None when it has none
+    """
+    result = subprocess.run([get_ffmpeg_exe(), "-hide_banner", "-i", path], capture_output=True, text=True)
+    match = re.search(r"Stream #\S+.*?: Audio: (\w+)", result.stderr)
+    return match.group(1) if match else None
+
+
+def audio_params(audio_path, output_path, bitrate="192k", shortest=False):
+    # stream copy when the output container takes the source codec as is, otherwise encode aac.
+    # every video frame is kept by default, shortest also ends the output with a shorter soundtrack
+    codec = probe_audio_codec(audio_path)
+    allowed = COPY_AUDIO_CODECS.get(os.path.splitext(output_path)[1].lower(), set())
+    if codec is not None and (allowed is None or codec in allowed):
+        params = ["-c:a", "copy"]
+    else:
+        params = ["-c:a", "aac", "-b:a", bitrate]
+    return params + ["-shortest"] if shortest else params
+
+
+def encoder_params(codec, preset=None, crf=23, threads=None):
+    # quality / speed options in the dialect of each encoder, crf=None leaves rate control to a bitrate
+    params = []
+    if codec in ("libx264", "libx265"):
+        params += ["-preset", preset or "medium"]
+        if crf is not None:
+            params += ["-crf", str(crf)]
+    elif codec.endswith("_nvenc"):
+        params += ["-preset", preset or "p5"]
+        if crf is not None:
+            params += ["-rc", "vbr", "-cq", str(crf)]
+    elif crf is not None:
+        # mpeg4 and other qscale encoders
+        params += ["-q:v", str(max(1, min(31, round(crf / 5))))]
+    if threads:
+        params += ["-threads", str(threads)]
+    return params
+
+
+class FFmpegWriter:
+    """
+    Encodes RGB uint8 frames by writing their raw bytes straight into an ffmpeg subprocess through memoryviews.
+    codec: fixed encoder, or None for the first working one in preference
+    preset, crf, threads: encoder options, see encoder_params
+    audio: optional video or audio file whose first audio track is muxed in while the frames are encoded,
+           copied when the container allows it, else encoded to aac
+    shortest: cut the output at the end of the shorter of video and audio, frames written after a shorter
+              soundtrack ended are dropped. Off by default, every frame is kept with the whole soundtrack.
+    encode_fps is available after close(), it only counts the time spent in write() and in the final flush,
+    not the time the caller takes between frames.
+    """
+
+    def __init__(self, output_path, width, height, fps=25, codec=None, preference=ENCODER_PREFERENCE, preset=None,
+                 crf=23, threads=None, audio=None, audio_bitrate="192k", shortest=False):
+        self.output_path = output_path
+        self.shape = (height, width, 3)
+        self.codec = codec or pick_encoder(preference)
+        self.frames = 0
+        self.elapsed = 0.0
+        self.ended = False
+        command = [get_ffmpeg_exe(), "-y", "-hide_banner", "-loglevel", "error",
+                   "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-"]
+        if audio is not None:
+            command += ["-i", audio, "-map", "0:v:0", "-map", "1:a:0?"]
+            command += audio_params(audio, output_path, audio_bitrate, shortest)
+        else:
+            command += ["-an"]
+        if width % 2 or height % 2:
+            # yuv420p needs even dimensions
+            command += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"]
+        command += ["-c:v", self.codec] + encoder_params(self.codec, preset, crf, threads)
+        command += ["-pix_fmt", "yuv420p", output_path]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def encode_fps(self):
+        return self.frames / self.elapsed if self.elapsed > 0 else 0.0
+
+    def write(self, frame):
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if frame.shape != self.shape:
+            raise ValueError(f"frame shape {frame.shape} does not match writer shape {self.shape}")
+        if self.ended:
+            return
+        start = time.perf_counter()
+        try:
+            with metrics.timer("encode"):
+                self.process.stdin.write(memoryview(frame).cast("B"))
+        except BrokenPipeError:
+            if self.process.wait() == 0:
+                # with shortest the output ends with a shorter soundtrack, the remaining frames are dropped
+                print(f"Warning: audio ended, {self.output_path} stops after {self.frames} frames")
+                self.ended = True
+                return
+            raise RuntimeError(f"ffmpeg encoder exited: {self.process.stderr.read().decode(errors='ignore')}")
+        self.elapsed += time.perf_counter() - start
+        self.frames += 1
+
+    # drop-in for imageio writers
+    append_data = write
+
+    def close(self):
+        if self.process.stdin.closed:
+            return
+        start = time.perf_counter()
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        error = self.process.stderr.read().decode(errors="ignore")
+        self.process.wait()
+        self.elapsed += time.perf_counter() - start
+        if self.process.returncode != 0:
+            raise RuntimeError(f"ffmpeg encoder failed: {error}")
+        print(f"encoded {self.frames} frames with {self.codec} at {self.encode_fps:.1f} fps")
+
 
 def read_frame_from_video(video_path, frame_number):
     # load video
@@ -23,8 +189,110 @@ def read_frame_from_video(video_path, frame_number):
         return None
 
 
+class FrameReader:
+    """
+    Random access to the frames of one video through a capture that stays open.
+    Decoded frames go into an LRU cache bounded by max_cache_bytes. Nearby forward requests are served
+    by grabbing ahead instead of seeking, batches are read in sorted order so access stays sequential.
+    rgb: return RGB instead of OpenCV's BGR
+    Frames are returned read-only since they are shared with the cache, copy before editing.
+    """
+
+    def __init__(self, video_path, max_cache_bytes=512 * 1024 ** 2, rgb=False, seek_threshold=32):
+        self.video_path = video_path
+        self.cap = cv2.VideoCapture(video_path)
+        if not self.cap.isOpened():
+            raise IOError(f"Cannot open video file {video_path}")
+        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.max_cache_bytes = max_cache_bytes
+        self.rgb = rgb
+        self.seek_threshold = seek_threshold
+        # index of the frame the next cap.read() returns
+        self.position = 0
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.seeks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.frame_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.read_range(*index.indices(self.frame_count))
+        return self.read(index)
+
+    def close(self):
+        self.cap.release()
+        self.cache.clear()
+        self.cache_bytes = 0
+
+    def _decode(self, index):
+        if not self.position <= index < self.position + self.seek_threshold:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+            self.seeks += 1
+            self.position = index
+        # grab() skips decoding the frames in between
+        while self.position < index:
+            if not self.cap.grab():
+                break
+            self.position += 1
+        ret, frame = self.cap.read()
+        if not ret or self.position != index:
+            self.position = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+            raise IndexError(f"cannot read frame {index} of {self.video_path}")
+        self.position += 1
+        if self.rgb:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+        frame.flags.writeable = False
+        return frame
+
+    def _remember(self, index, frame):
+        self.cache[index] = frame
+        self.cache_bytes += frame.nbytes
+        while self.cache_bytes > self.max_cache_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_bytes -= evicted.nbytes
+
+    def read(self, index):
+        if index < 0:
+            index += self.frame_count
+        frame = self.cache.get(index)
+        if frame is not None:
+            self.cache.move_to_end(index)
+            self.hits += 1
+            return frame
+        self.misses += 1
+        frame = self._decode(index)
+        self._remember(index, frame)
+        return frame
+
+    def read_batch(self, indices):
+        """
+        return: frames in the order of indices, decoded in ascending frame order
+        """
+        indices = [index + self.frame_count if index < 0 else index for index in indices]
+        frames = {index: self.read(index) for index in sorted(set(indices))}
+        return [frames[index] for index in indices]
+
+    def read_range(self, start, stop, step=1):
+        return self.read_batch(range(start, stop, step))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "seeks": self.seeks, "cached_frames": len(self.cache),
+                "cached_bytes": self.cache_bytes}
+
+
 # merge video and audio
-def merge_video_audio(video_path, audio_path, output_path):
+def merge_video_audio(video_path, audio_path, output_path, shortest=False):
     # check video format
     if not (
             video_path.endswith(".mp4")
@@ -37,10 +305,11 @@ def merge_video_audio(video_path, audio_path, output_path):
         print("Invalid audio format. Supported formats are mp3, wav.")
         return
 
-    # merge video and audio
-    command = f'ffmpeg -y -i "{video_path}" -i "{audio_path}" -c:v copy -c:a aac -b:a 5000k "{output_path}"'
+    # merge video and audio, prefer writing the audio with FFmpegWriter(audio=...) while encoding
+    command = [get_ffmpeg_exe(), "-y", "-nostdin", "-i", video_path, "-i", audio_path, "-map", "0:v:0", "-map", "1:a:0",
+               "-c:v", "copy"] + audio_params(audio_path, output_path, shortest=shortest) + [output_path]
     try:
-        subprocess.run(command, shell=True, check=True)
+        subprocess.run(command, check=True)
         print("success")
     except subprocess.CalledProcessError as e:
         print("failed:", e)
@@ -60,29 +329,70 @@ def extract_video_stream(video_path, bitrate="5000k", resize_width=None, resize_
     if resize_width and resize_height:
         if video.size[0] > resize_width and video.size[1] > resize_width:
             video = video.resize(height=resize_height, width=resize_width)
-    # set output params
-    output_params = ["-vcodec", "h264_nvenc", "-preset", "slow", "-crf", "23"]
-    video.write_videofile(output_path, codec="libx264", bitrate=bitrate, ffmpeg_params=output_params)
+    # set output params, rate control comes from the bitrate
+    codec = pick_encoder()
+    output_params = encoder_params(codec, preset="slow", crf=None)
+    video.write_videofile(output_path, codec=codec, bitrate=bitrate, ffmpeg_params=output_params)
 
     print(f"Processed video saved as {output_path}")
 
 
-def merge_video_with_alpha(video_path, alpha_path, output_path, bitrate="5000k"):
-    # load videos
-    inference_video = VideoFileClip(video_path)
-    alpha_video = VideoFileClip(alpha_path)
+def _video_height(video_path):
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Cannot open video file {video_path}")
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    return height
+
+
+def _stack_videos_ffmpeg(video_paths, output_path, bitrate):
+    # every input scaled to the smallest height (even, for yuv420p) and stacked left to right in one filter graph
+    height = min(_video_height(path) for path in video_paths) // 2 * 2
+    scaled = [f"[{i}:v]scale=-2:{height},setsar=1[v{i}]" for i in range(len(video_paths))]
+    if len(video_paths) > 1:
+        inputs = "".join(f"[v{i}]" for i in range(len(video_paths)))
+        stack = f"{inputs}hstack=inputs={len(video_paths)}[out]"
+    else:
+        stack = "[v0]null[out]"
+    codec = pick_encoder()
+    command = [get_ffmpeg_exe(), "-y", "-nostdin", "-loglevel", "error"]
+    for path in video_paths:
+        command += ["-i", path]
+    command += ["-filter_complex", ";".join(scaled + [stack]), "-map", "[out]", "-an",
+                "-c:v", codec, "-b:v", bitrate] + encoder_params(codec, preset="slow", crf=None)
+    command += ["-pix_fmt", "yuv420p", output_path]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+
+
+def _stack_videos_moviepy(video_paths, output_path, bitrate):
+    clips = [VideoFileClip(path) for path in video_paths]
+    target_height = min(clip.h for clip in clips)
+    final_clip = clips_array([[clip.resize(height=target_height) for clip in clips]]).without_audio()
+    # set output params, rate control comes from the bitrate
+    codec = pick_encoder()
+    output_params = encoder_params(codec, preset="slow", crf=None)
+    final_clip.write_videofile(output_path, codec=codec, bitrate=bitrate, ffmpeg_params=output_params)
+    for clip in clips:
+        clip.close()
+
 
-    # check video size
-    target_height = min(inference_video.h, alpha_video.h)
-    inference_video = inference_video.resize(height=target_height)
-    alpha_video = alpha_video.resize(height=target_height)
+def stack_videos(video_paths, output_path, bitrate="5000k", use_ffmpeg=True):
+    """
+    Side by side render of any number of videos, e.g. original, swapped and alpha, scaled to the smallest height.
+    The ffmpeg filter graph path never brings the pixels into python, moviepy is the fallback.
+    """
+    if use_ffmpeg:
+        try:
+            _stack_videos_ffmpeg(video_paths, output_path, bitrate)
+            return
+        except (OSError, RuntimeError) as e:
+            print(f"Warning: ffmpeg stacking failed, falling back to moviepy: {e}")
+    _stack_videos_moviepy(video_paths, output_path, bitrate)
 
-    # create final clip
-    final_clip = clips_array([[inference_video, alpha_video]]).without_audio()
-    # set output params
-    output_params = ["-vcodec", "h264_nvenc", "-preset", "slow", "-crf", "23"]
-    final_clip.write_videofile(output_path, codec="libx264", bitrate=bitrate, ffmpeg_params=output_params)
 
-    # 关闭视频文件
-    inference_video.close()
-    alpha_video.close()
+def merge_video_with_alpha(video_path, alpha_path, output_path, bitrate="5000k", extra_paths=()):
+    # extra_paths are stacked to the right of the alpha video
+    stack_videos([video_path, alpha_path, *extra_paths], output_path, bitrate)